@@ -1,45 +1,197 @@
-﻿import discord, os, asyncio, time, random, youtube_dl, datetime
+﻿import time
+startup = {"import": time.perf_counter()} # perf_counter marks of the startup phases, "voice" is a duration
+import discord, os, asyncio, random, datetime, collections, itertools, io, json, signal, threading, sys, traceback
 from discord.ext.commands import Bot
 from discord.ext import commands
 from discord.utils import get
+from logsink import LogSink
+from presence import OnlineRegistry
+from resolver import Resolver, createPlayer, isPlaylist, loadYoutubeDL, FFMPEG_BEFORE
+from audiocache import AudioCache, readFrames, trackKey
+from pcm import PCMStage, GainCache, clampVolume, MAX_VOLUME
+from opusplayer import FramePlayer, OggOpusSource, Incompatible, StreamCost, CostTotals, CountedReads, CountedFrames
+from transcoder import TranscoderPool, TranscodedStream, decodeArgs
+from idle import IdleScheduler
+from journal import QueueJournal, entryRecord
+from songqueue import SongQueue
+from voicepool import VoiceConnector
+from nowplaying import StatusMessage, progressBar
+from metrics import Metrics, Profiler
+from audit import ChannelIndex, AuditPipeline, roleDiff
+from messagestore import MessageStore
+from messagelog import MessageLog, Retention, snowflakeTime
+from ratelimit import Cooldown
+
+PREFIX = '47!'
+
+# set by shards.py when the bot runs as one of several shard processes
+SHARD_ID = int(os.environ.get("SHARD_ID", "0"))
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "0"))
+
+# deletes and edits are audited from the message store below, the library's
+# own message cache is kept at its minimum
+if SHARD_COUNT > 1:
+    client=commands.Bot(command_prefix =PREFIX, description='A useful bot.', max_messages=100, shard_id=SHARD_ID, shard_count=SHARD_COUNT)
+    logSuffix = "-" + str(SHARD_ID)
+else:
+    client=commands.Bot(command_prefix =PREFIX, description='A useful bot.', max_messages=100)
+    logSuffix = ""
+
+chatLog = LogSink(os.path.join("logs", "log" + logSuffix + ".txt"))
+eventLog = LogSink(os.path.join("logs", "clog" + logSuffix + ".txt"))
+channels = ChannelIndex(os.environ.get("AUDIT_CHANNEL", "bot"), os.path.join("config", "audit.json"))
+auditLog = AuditPipeline(client)
+online = OnlineRegistry()
+messages = MessageStore(int(os.environ.get("MESSAGE_STORE_MB", "64")) * 1024 * 1024)
+# searchable chat history, LOG_RETENTION_DAYS applies unless config/retention.json says otherwise
+# unset keeps messages forever, 0 does not store them
+retentionDays = os.environ.get("LOG_RETENTION_DAYS", "").strip()
+messageLog = MessageLog(os.path.join("logs", "messages" + logSuffix + ".db"),
+                        Retention.load(os.path.join("config", "retention.json"), days=int(retentionDays) if retentionDays else None))
+metrics = Metrics()
+profiler = Profiler()
+
+OWNER_ID = os.environ.get("OWNER_ID") # filled in from the application info on ready when not set
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9147")) # 0 turns the endpoint off
+if METRICS_PORT and "SHARD_ID" in os.environ:
+    # the supervisor serves the merged metrics on METRICS_PORT itself
+    METRICS_PORT += 1 + SHARD_ID
+
+PREFETCH_DEPTH = int(os.environ.get("PREFETCH_DEPTH", "1"))
+STALE_AFTER = 20 * 60 # stream URLs resolved longer ago than this are resolved again
+AUDIO_CACHE_MB = int(os.environ.get("AUDIO_CACHE_MB", "1024"))
+IDLE_TIMEOUT = int(os.environ.get("IDLE_TIMEOUT", "60"))
+PLAYLIST_LIMIT = int(os.environ.get("PLAYLIST_LIMIT", "500"))
+VOICE_HANDSHAKES = int(os.environ.get("VOICE_HANDSHAKES", "4")) # voice connections being established at once
+PASSTHROUGH_MAX_KBPS = int(os.environ.get("PASSTHROUGH_MAX_KBPS", "192")) # Opus streams up to this bitrate are sent without transcoding, 0 turns it off
+TRANSCODER_WORKERS = int(os.environ.get("TRANSCODER_WORKERS", str(max(1, (os.cpu_count() or 1) // max(SHARD_COUNT, 1))))) # 0 transcodes in the bot process
+DEFAULT_VOLUME = 0.6
+def idSet(name, default=""):
+    return frozenset(id.strip() for id in os.environ.get(name, default).split(",") if id.strip())
+
+IGNORED_USERS = idSet("IGNORED_USERS", "235088799074484224") # left out of the chat log, Rythm by default
+BLOCKED_USERS = idSet("BLOCKED_USERS") # their commands are not run
+# plays per user and per server, both have to have a token left
+playCooldown = Cooldown(int(os.environ.get("PLAY_USER_RATE", "3")), 10, int(os.environ.get("PLAY_SERVER_RATE", "10")), 10)
+QUEUE_LIMIT = int(os.environ.get("QUEUE_LIMIT", "500")) # queued songs per user and server, 0 for no limit
+QUEUE_FULL = "You already have {} songs queued, wait for some of them to play first.".format(QUEUE_LIMIT)
+
+VOICE_WARMUP_DELAY = 5 # seconds after the first ready before voice support is loaded in the background
+QUEUE_JOURNAL = os.path.join("data", "queues" + logSuffix + ".jsonl")
+POSITION_INTERVAL = 10 # seconds between journaled playback positions
 
-client=commands.Bot(command_prefix ='47!', description='A useful bot.')
-
-
-
-if not discord.opus.is_loaded():
-    # the 'opus' library here is opus.dll on windows
-    # or libopus.so on linux in the current directory
-    # you should replace this with the location the
-    # opus library is located in and with the proper filename.
-    # note that on windows this DLL is automatically provided for you
-    discord.opus.load_opus('libopus.so')
 	
 #Classes
 
+entryIds = itertools.count()
+
 class VoiceEntry:
-    def __init__(self, message, player):
-        self.requester = message.author
-        self.channel = message.channel
-        self.player = player
+    def __init__(self, requester, channel, query, info, volume=DEFAULT_VOLUME, offset=0):
+        self.id = next(entryIds)
+        self.requester = requester
+        self.channel = channel
+        self.query = query
+        self.info = info
+        self.volume = clampVolume(volume)
+        self.offset = offset # seconds into the track to start from, or played before the last pause
+        self.started = None
+        self.paused = False
+        self.player = None
+        self.stage = None # volume and normalization of ffmpeg players, cached and passed through tracks play as encoded
+        self.cost = None
+        self.prepared = None
+        self.skip_votes = set() # a set of user_ids that voted
+        self.skipped = False # while it was still being prepared
+
+    @property
+    def encoded(self):
+        """Whether the entry may play as encoded packets: from the audio cache, whose frames are
+        encoded at DEFAULT_VOLUME, or passed through. Only while nobody changed its volume."""
+        return self.volume == DEFAULT_VOLUME
+
+    def set_volume(self, volume):
+        self.volume = clampVolume(volume)
+        if self.stage is not None:
+            self.stage.volume = self.volume
+        return self.volume
+
+    def position(self):
+        if self.started is None or self.paused:
+            return self.offset
+        return self.offset + time.monotonic() - self.started
+
+    def pause(self):
+        """Folds the time played so far into offset, the position stands still until resume()."""
+        if self.started is not None and not self.paused:
+            self.offset = self.position()
+            self.paused = True
+
+    def resume(self):
+        if self.paused:
+            self.started = time.monotonic()
+            self.paused = False
+
+    def close(self):
+        if self.prepared is not None:
+            self.prepared.cancel()
+        if self.player is not None:
+            self.player.stop()
+            process = getattr(self.player, 'process', None)
+            if self.player.ident is None and process is not None:
+                # a ProcessPlayer only kills its ffmpeg at the end of run(), which never ran
+                process.kill()
+                if process.poll() is None:
+                    process.communicate()
+
+    def release(self):
+        """Drops the prepared player, the entry is prepared again once it is near the front."""
+        self.close()
+        self.prepared = self.player = self.stage = None
 
     def __str__(self):
-        fmt = '*{0.title}* uploaded by {0.uploader} and requested by {1.display_name}'
-        duration = self.player.duration
+        fmt = '*{0[title]}* uploaded by {0[uploader]} and requested by {1.display_name}'
+        duration = self.info.get('duration')
         if duration:
-            fmt = fmt + ' [length: {0[0]}m {0[1]}s]'.format(divmod(duration, 60))
-        return fmt.format(self.player, self.requester)
+            fmt = fmt + ' [length: {0[0]}m {0[1]}s]'.format(divmod(int(duration), 60))
+        return fmt.format(self.info, self.requester)
 		
 #------------------------------------------------------------------------------------------------------------
 	
+class _FirstRead:
+    """Wraps a player's buffer to time its first frame, then gets out of the way."""
+    def __init__(self, player, callback):
+        self.player = player
+        self.raw = player.buff
+        self.callback = callback
+
+    def read(self, size):
+        data = self.raw.read(size)
+        self.player.buff = self.raw
+        self.callback()
+        return data
+
 class VoiceState:
-    def __init__(self, bot):
+    def __init__(self, bot, key, resolver, idle, cache=None, journal=None, gains=None, costs=None, transcoders=None, prefetch_depth=PREFETCH_DEPTH):
         self.current = None
         self.voice = None
+        self.connected = asyncio.Event() # set while there is a voice client to play on
+        self.resumed = None # entry cut off by a dropped connection, it continues on the next one
         self.bot = bot
+        self.key = key
+        self.idle = idle
+        self.resolver = resolver
+        self.cache = cache
+        self.journal = journal
+        self.gains = gains
+        self.costs = costs
+        self.transcoders = transcoders
+        self.prefetch_depth = prefetch_depth
+        self.gaps = collections.deque(maxlen=50) # seconds between the end of a track and the next one's first frame
         self.play_next_song = asyncio.Event()
-        self.songs = asyncio.Queue()
-        self.skip_votes = set() # a set of user_ids that voted
+        self.songs = SongQueue(lambda entry: entry.requester.id, QUEUE_LIMIT or None, loop=bot.loop)
+        self.loader = None # task expanding a playlist into the queue
+        self.status = StatusMessage(bot, self.status_text)
         self.audio_player = self.bot.loop.create_task(self.audio_player_task())
 
     def is_playing(self):
@@ -47,30 +199,255 @@ class VoiceState:
             return False
 
         player = self.current.player
-        return not player.is_done()
+        # a player that is still being prepared counts as playing
+        return player is None or not player.is_done()
 
     @property
     def player(self):
         return self.current.player
 
     def skip(self):
-        self.skip_votes.clear()
-        if self.is_playing():
+        if not self.is_playing():
+            return
+        if self.player is not None:
             self.player.stop()
+        else:
+            # audio_player_task drops it once it is prepared
+            self.current.skipped = True
+
+    def status_text(self):
+        entry = self.current
+        if entry is None or self.play_next_song.is_set():
+            lines = ['Nothing playing.']
+        elif entry.started is None:
+            lines = ['Starting *{}*...'.format(entry.info.get('title'))]
+        else:
+            passthrough = entry.cost is not None and entry.cost.path == 'passthrough'
+            volume = 'as encoded' if passthrough else '{:.0%}'.format(entry.volume)
+            lines = ['**Now playing** ' + str(entry),
+                     '{} volume {} [skips: {}/3]'.format(progressBar(entry.position(), entry.info.get('duration')), volume, len(entry.skip_votes))]
+        upcoming = self.songs.peek(3)
+        if upcoming:
+            lines.append('**Up next** ({} queued):'.format(len(self.songs)))
+            for position, queued in enumerate(upcoming, 1):
+                lines.append('`{}.` *{}* requested by {}'.format(position, queued.info.get('title'), queued.requester.display_name))
+        return '\n'.join(lines)
+
+    def attach(self, voice):
+        self.voice = voice
+        self.connected.set()
+        self.prefetch()
+
+    def suspend(self):
+        """Detaches a dropped voice client and returns it, the queue waits for the next one.
+
+        Players only play on the client they were made for. The queued ones
+        are prepared again, the current song continues where it stopped.
+        """
+        voice, self.voice = self.voice, None
+        self.connected.clear()
+        for entry in self.songs.peek(self.prefetch_depth):
+            if entry.prepared is not None:
+                entry.release()
+        self.replay()
+        return voice
+
+    def replay(self):
+        """Prepares the current song again to continue where it is, returns whether there was one playing."""
+        entry = self.current
+        if entry is None or entry.started is None or self.play_next_song.is_set():
+            return False
+        entry.offset = entry.position()
+        entry.started = None
+        entry.paused = False # the new player starts playing
+        self.resumed = entry
+        entry.release()
+        return True
 
     def toggle_next(self):
         self.bot.loop.call_soon_threadsafe(self.play_next_song.set)
 
+    def record(self, op, **fields):
+        if self.journal is not None:
+            self.journal.record(op, self.key, **fields)
+
+    async def enqueue(self, entry):
+        """Queues the entry, raises asyncio.QueueFull when its requester is at QUEUE_LIMIT."""
+        await self.songs.put(entry)
+        self.record('add', e=entry.id, d=entryRecord(entry))
+        self.status.added(entry.info.get('title'), entry.requester.display_name, entry.channel)
+
+    def discard(self, entries):
+        """Closes entries taken out of the queue."""
+        for entry in entries:
+            entry.close()
+            self.record('done', e=entry.id)
+        self.prefetch()
+        self.status.update()
+
+    def reordered(self):
+        """Journals the queue order after a move or shuffle and moves the look-ahead along."""
+        for entry in itertools.islice(self.songs, self.prefetch_depth, None):
+            if entry.prepared is not None:
+                entry.release()
+        self.record('order', e=[entry.id for entry in self.songs])
+        self.prefetch()
+        self.status.update()
+
+    def clear(self):
+        """Drops every queued entry and stops the players prepared for them."""
+        while not self.songs.empty():
+            self.songs.get_nowait().close()
+
+    async def _prepare(self, entry):
+        gain = self.gains.get(trackKey(entry.info)) if self.gains is not None else None
+        if entry.encoded and self.cache is not None:
+            path = self.cache.lookup(entry.info)
+            if path is not None:
+                entry.cost = StreamCost('cached')
+                entry.player = FramePlayer(CountedFrames(readFrames(path, skip=int(entry.offset * 50)), entry.cost), self.voice, after=self.toggle_next)
+                return
+
+        if time.time() - entry.info['resolved_at'] > STALE_AFTER:
+            entry.info = await self.resolver.resolve(entry.query, refresh=True)
+        before = FFMPEG_BEFORE
+        if entry.offset:
+            before += ' -ss {:.1f}'.format(entry.offset)
+        if self.cache is not None:
+            self.cache.note_play(entry.info, gain)
+
+        # packets are sent unscaled and unnormalized, at the loudness of the source
+        if entry.encoded and canPassthrough(entry.info):
+            source = OggOpusSource(entry.info['url'], entry.info.get('http_headers'), before)
+            opening = self.bot.loop.run_in_executor(None, source.open)
+            try:
+                await opening
+            except Incompatible:
+                if self.costs is not None:
+                    self.costs.incompatible += 1
+            except asyncio.CancelledError:
+                opening.add_done_callback(lambda f: source.close())
+                raise
+            else:
+                entry.cost = StreamCost('passthrough', source.pid)
+                entry.player = FramePlayer(CountedFrames(source, entry.cost), self.voice, after=self.toggle_next)
+                return
+
+        measured = None
+        if self.gains is not None and gain is None:
+            key = trackKey(entry.info)
+            measured = lambda gain: self.gains.put(key, gain)
+
+        if self.transcoders is not None:
+            source = TranscodedStream(self.transcoders, decodeArgs(entry.info['url'], entry.info.get('http_headers'), before), entry.volume, gain, measured)
+            opening = self.bot.loop.run_in_executor(None, source.open)
+            try:
+                await opening
+            except asyncio.CancelledError:
+                opening.add_done_callback(lambda f: source.close())
+                raise
+            entry.stage = source
+            entry.cost = StreamCost('pooled', source.pid, source.cpu_seconds)
+            entry.player = FramePlayer(CountedFrames(source, entry.cost), self.voice, after=self.toggle_next)
+            return
+
+        entry.player = createPlayer(self.voice, entry.info, before_options=before, after=self.toggle_next)
+        entry.stage = PCMStage(entry.player.buff, entry.volume, gain, measured)
+        process = getattr(entry.player, 'process', None)
+        entry.cost = StreamCost('transcode', process.pid if process is not None else None)
+        entry.player.buff = CountedReads(entry.stage, entry.cost)
+
+    async def prepare(self, entry):
+        """Makes sure the entry has a fresh stream URL and a spawned player."""
+        if entry.prepared is None:
+            entry.prepared = self.bot.loop.create_task(self._prepare(entry))
+        await entry.prepared
+
+    def prefetch(self):
+        """Starts preparing the next few queued entries so their streams are buffered."""
+        if self.voice is None:
+            return
+        for entry in self.songs.peek(self.prefetch_depth):
+            if entry.prepared is None:
+                entry.prepared = self.bot.loop.create_task(self._prepare(entry))
+
     async def audio_player_task(self):
+        ended = None
         while True:
             self.play_next_song.clear()
-            self.current = await self.songs.get()
-            await self.bot.send_message(self.current.channel, 'Now playing ' + str(self.current))
-            self.current.player.start()
+            resuming = self.resumed is not None
+            if resuming:
+                self.current, self.resumed = self.resumed, None
+                ended = None
+            else:
+                if self.songs.empty():
+                    self.idle.arm(self.key)
+                    self.current = None
+                    self.status.update()
+                self.current = await self.songs.get()
+                self.idle.cancel(self.key)
+                self.record('current', e=self.current.id)
+            await self.connected.wait()
+            voice = self.voice
+            try:
+                await self.prepare(self.current)
+            except Exception as e:
+                if self.voice is not voice:
+                    # the connection dropped while the player was made
+                    self.resumed = self.current
+                    self.current.release()
+                    continue
+                self.record('done', e=self.current.id)
+                self.status.note('Could not play *{}*: `{}: {}`'.format(self.current.info.get('title'), type(e).__name__, e), self.current.channel)
+                continue
+            if self.voice is not voice:
+                self.resumed = self.current
+                self.current.release()
+                continue
+            if self.current.skipped:
+                self.record('done', e=self.current.id)
+                self.current.close()
+                continue
+
+            player = self.current.player
+            if ended is not None:
+                if hasattr(player, 'buff'):
+                    player.buff = _FirstRead(player, lambda ended=ended: self.gaps.append(time.monotonic() - ended))
+                else:
+                    # cached tracks have their first frame at hand
+                    self.gaps.append(time.monotonic() - ended)
+            player.start()
+            self.current.started = time.monotonic()
+            self.prefetch()
+            self.status.update(None if resuming else self.current.channel)
             await self.play_next_song.wait()
+            if self.resumed is self.current:
+                continue
+            self.record('done', e=self.current.id)
+            if self.costs is not None and self.current.cost is not None:
+                self.costs.add(self.current.cost)
+            # only gaps between back to back tracks are measured
+            ended = time.monotonic() if not self.songs.empty() else None
 
 #------------------------------------------------------------------------------------------------------------
 
+def canPassthrough(info):
+    """Whether youtube_dl picked an Opus stream that can be sent without transcoding."""
+    return PASSTHROUGH_MAX_KBPS > 0 and info.get('acodec') == 'opus' and (info.get('abr') or 0) <= PASSTHROUGH_MAX_KBPS
+
+async def playRateLimited(bot, message):
+    """Takes a use of play for the author, or tells them once to slow down and returns True.
+
+    Not a command check, help runs those for every command it lists.
+    """
+    server = message.server
+    retry = playCooldown.retry_after(message.author.id, server.id if server is not None else None)
+    if not retry:
+        return False
+    if playCooldown.warn(message.author.id):
+        await bot.send_message(message.channel, "Slow down, try again in {:.0f}s.".format(retry + 0.5))
+    return True
+
 class Music:
     """Voice related commands.
 
@@ -79,48 +456,167 @@ class Music:
     def __init__(self, bot):
         self.bot = bot
         self.voice_states = {}
+        self.resolver = Resolver(bot.loop, observe=metrics.histogram("resolve_seconds").observe)
+        # the shards share the folder, each keeps to its part of AUDIO_CACHE_MB
+        self.cache = AudioCache(os.path.join("cache", "audio"), max_bytes=AUDIO_CACHE_MB * 1024 * 1024 // max(SHARD_COUNT, 1), volume=DEFAULT_VOLUME)
+        self.idle = IdleScheduler(bot.loop, IDLE_TIMEOUT, self.is_idle, self.teardown)
+        self.connector = VoiceConnector(bot, VOICE_HANDSHAKES, observe=metrics.histogram("voice_connect_seconds").observe, dropped=self.voice_dropped)
+        self.journal = QueueJournal(QUEUE_JOURNAL)
+        self.gains = GainCache(os.path.join("cache", "gains.json"))
+        self.costs = CostTotals()
+        self.transcoders = TranscoderPool(TRANSCODER_WORKERS) if TRANSCODER_WORKERS > 0 else None
+        self.voice_loaded = False
+        self._voice_lock = threading.Lock()
+
+    def load_voice(self):
+        """Loads opus, youtube_dl and the audio cache index, runs in a worker thread."""
+        with self._voice_lock:
+            if self.voice_loaded:
+                return
+            started = time.perf_counter()
+            if not discord.opus.is_loaded():
+                # the 'opus' library here is opus.dll on windows
+                # or libopus.so on linux in the current directory
+                # you should replace this with the location the
+                # opus library is located in and with the proper filename.
+                # note that on windows this DLL is automatically provided for you
+                discord.opus.load_opus('libopus.so')
+            loadYoutubeDL()
+            self.cache.load()
+            self.gains.load()
+            self.voice_loaded = True
+            startup["voice"] = time.perf_counter() - started
+
+    async def ensure_voice(self):
+        if not self.voice_loaded:
+            await self.bot.loop.run_in_executor(None, self.load_voice)
 
     def get_voice_state(self, server):
         state = self.voice_states.get(server.id)
         if state is None:
-            state = VoiceState(self.bot)
+            state = VoiceState(self.bot, server.id, self.resolver, self.idle, self.cache, self.journal, self.gains, self.costs, self.transcoders)
             self.voice_states[server.id] = state
 
         return state
 
-    async def stopAfter(self, ctx):
-        while True:
-            await asyncio.sleep(30)
-            val = self.get_voice_state(ctx.message.server).is_playing()
-            if val == False:
-                server = ctx.message.server
-                state = self.get_voice_state(server)
-
-                if state.is_playing():
-                    player = state.player
-                    player.stop()
-                try:
-                    state.audio_player.cancel()
-                    del self.voice_states[server.id]
-                    await state.voice.disconnect()
-                except:
-                    pass
-                break
-                
+    def is_idle(self, server_id):
+        state = self.voice_states.get(server_id)
+        return state is None or (not state.is_playing() and state.songs.empty())
+
+    async def teardown(self, server_id):
+        """Stops playback, drops the queue and leaves the voice channel."""
+        state = self.voice_states.pop(server_id, None)
+        if state is None:
+            return
+        self.journal.record('clear', server_id)
+        self.idle.cancel(server_id)
+        if state.loader is not None:
+            state.loader.cancel()
+        state.clear()
+        if state.current is not None:
+            state.current.close()
+        state.audio_player.cancel()
+        await state.status.close('Left the voice channel.')
+        if state.voice is not None:
+            await self.connector.disconnect(state.voice)
+        await self.bot.loop.run_in_executor(None, self.gains.save)
 
     async def create_voice_client(self, channel):
-        voice = await self.bot.join_voice_channel(channel)
+        await self.ensure_voice()
+        voice = await self.connector.connect(channel)
         state = self.get_voice_state(channel.server)
-        state.voice = voice
+        state.attach(voice)
+        state.record('voice', c=channel.id)
+
+    def voice_dropped(self, voice):
+        self.bot.loop.create_task(self.reconnect(voice.server.id))
+
+    async def reconnect(self, server_id):
+        """Connects a server whose voice connection dropped again, its queue and current song are kept."""
+        state = self.voice_states.get(server_id)
+        if state is None or state.voice is None:
+            return
+        channel = state.voice.channel
+        await self.connector.disconnect(state.suspend())
+        try:
+            voice = await self.connector.connect(channel)
+        except Exception as e:
+            clog("Could not reconnect to ", channel.name, " in ", channel.server.name, ": ", e)
+            await self.teardown(server_id)
+            return
+        if self.voice_states.get(server_id) is not state:
+            # torn down while reconnecting
+            await self.connector.disconnect(voice)
+            return
+        state.attach(voice)
+        clog("Reconnected to ", channel.name, " in ", channel.server.name)
+
+    async def restore_queues(self):
+        """Rejoins the voice channels in the queue journal and enqueues their songs again.
+
+        The song that was playing continues from its last journaled position.
+        Servers are rejoined concurrently, as fast as the voice connector allows.
+        """
+        # taken before the clears below, they remove the servers from the journal's state
+        saved = list(self.journal.load().items())
+        self.journal.start()
+        for server_id, queue in saved:
+            # the entries are journaled again under new ids as they are enqueued
+            self.journal.record('clear', server_id)
+        await asyncio.gather(*(self.restore_queue(server_id, queue) for server_id, queue in saved))
+        self.bot.loop.create_task(self.journal_positions())
+
+    async def restore_queue(self, server_id, queue):
+        server = self.bot.get_server(server_id)
+        channel = server.get_channel(queue['voice']) if server is not None and queue['voice'] else None
+        if channel is None or not queue['entries']:
+            return
+        try:
+            await self.create_voice_client(channel)
+        except Exception as e:
+            clog("Could not rejoin ", channel.name, " in ", server.name, ": ", e)
+            return
+
+        state = self.get_voice_state(server)
+        entries = list(queue['entries'].items())
+        entries.sort(key=lambda item: item[0] != queue['current'])
+        dropped = 0
+        for entry_id, record in entries:
+            info = dict(record['i'], resolved_at=0)
+            requester = server.get_member(record['r']) or server.me
+            text = server.get_channel(record['c']) or server.default_channel
+            offset = queue['pos'] if entry_id == queue['current'] else 0
+            try:
+                await state.enqueue(VoiceEntry(requester, text, record['q'], info, volume=record['v'], offset=offset))
+            except asyncio.QueueFull:
+                dropped += 1
+        state.prefetch()
+        clog("Resumed ", len(entries) - dropped, " songs in ", server.name)
+        if dropped:
+            clog("Dropped ", dropped, " songs over the queue limit in ", server.name)
+
+    async def journal_positions(self):
+        while True:
+            await asyncio.sleep(POSITION_INTERVAL)
+            for state in self.voice_states.values():
+                if state.current is not None and state.current.started is not None and state.is_playing():
+                    state.record('pos', t=round(state.current.position(), 1))
 
     def __unload(self):
         for state in self.voice_states.values():
             try:
                 state.audio_player.cancel()
+                state.clear()
                 if state.voice:
-                    self.bot.loop.create_task(state.voice.disconnect())
+                    self.bot.loop.create_task(self.connector.disconnect(state.voice))
             except:
                 pass
+        self.idle.close()
+        self.connector.close()
+        self.journal.close()
+        self.gains.save()
+        self.resolver.shutdown()
+        self.cache.shutdown()
 
     @commands.command(pass_context=True, no_pm=True)
     async def join(self, ctx, *, channel : discord.Channel):
@@ -144,9 +640,11 @@ class Music:
 
         state = self.get_voice_state(ctx.message.server)
         if state.voice is None:
-            state.voice = await self.bot.join_voice_channel(summoned_channel)
+            await self.ensure_voice()
+            state.attach(await self.connector.connect(summoned_channel))
         else:
             await state.voice.move_to(summoned_channel)
+        state.record('voice', c=summoned_channel.id)
 
         return True
 
@@ -160,29 +658,90 @@ class Music:
         This command automatically searches as well from YouTube.
         The list of supported sites can be found here:
         https://rg3.github.io/youtube-dl/supportedsites.html
+
+        Playlists are enqueued in the background, playback starts
+        with the first track. Use cancel to stop loading one.
         """
+        if await playRateLimited(self.bot, ctx.message):
+            return
         state = self.get_voice_state(ctx.message.server)
-        opts = {
-            'default_search': 'auto',
-            'quiet': True,
-        }
 
         if state.voice is None:
             success = await ctx.invoke(self.summon)
             if not success:
                 return
 
+        if state.songs.room(ctx.message.author.id) == 0:
+            await self.bot.say(QUEUE_FULL)
+            return
+
+        if isPlaylist(song):
+            if state.loader is not None and not state.loader.done():
+                await self.bot.say('Already loading a playlist, use cancel to stop it first.')
+            else:
+                state.loader = self.bot.loop.create_task(self.load_playlist(ctx.message, state, song))
+            return
+
         try:
-            player = await state.voice.create_ytdl_player(song, ytdl_options=opts, after=state.toggle_next)
+            info = await self.resolver.resolve(song)
         except Exception as e:
             fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
             await self.bot.send_message(ctx.message.channel, fmt.format(type(e).__name__, e))
         else:
-            player.volume = 0.6
-            entry = VoiceEntry(ctx.message, player)
-            await self.bot.say('Enqueued ' + str(entry))
-            await state.songs.put(entry)
-            await self.stopAfter(ctx)
+            entry = VoiceEntry(ctx.message.author, ctx.message.channel, song, info)
+            try:
+                await state.enqueue(entry)
+            except asyncio.QueueFull:
+                await self.bot.say(QUEUE_FULL)
+                return
+            state.prefetch()
+
+    async def load_playlist(self, message, state, url):
+        progress = await self.bot.send_message(message.channel, 'Loading playlist...')
+        fmt = 'Loading playlist... {} enqueued'
+        count = 0
+        failed = 0
+        shown = time.monotonic()
+        try:
+            async for info in self.resolver.playlist(url, limit=PLAYLIST_LIMIT):
+                if count == 0:
+                    # the first track is resolved right away so it can start playing
+                    try:
+                        info = await self.resolver.resolve(info['webpage_url'])
+                    except Exception:
+                        failed += 1
+                        continue
+                try:
+                    await state.enqueue(VoiceEntry(message.author, message.channel, info['webpage_url'], info))
+                except asyncio.QueueFull:
+                    await self.bot.edit_message(progress, 'Stopped loading the playlist after {} tracks. '.format(count) + QUEUE_FULL)
+                    return
+                count += 1
+                if state.songs.qsize() <= state.prefetch_depth:
+                    state.prefetch()
+                if time.monotonic() - shown > 5:
+                    shown = time.monotonic()
+                    await self.bot.edit_message(progress, fmt.format(count))
+        except asyncio.CancelledError:
+            await self.bot.edit_message(progress, 'Stopped loading the playlist after {} tracks.'.format(count))
+            raise
+        except Exception as e:
+            fmt = 'Stopped loading the playlist after {} tracks: ```py\n{}: {}\n```'
+            await self.bot.edit_message(progress, fmt.format(count, type(e).__name__, e))
+        else:
+            fmt = 'Enqueued {} tracks from the playlist.'
+            if failed:
+                fmt += ' {} could not be played.'.format(failed)
+            await self.bot.edit_message(progress, fmt.format(count))
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def cancel(self, ctx):
+        """Stops loading a playlist, tracks enqueued so far are kept."""
+        state = self.get_voice_state(ctx.message.server)
+        if state.loader is None or state.loader.done():
+            await self.bot.say('No playlist is being loaded.')
+        else:
+            state.loader.cancel()
 
     @commands.command(pass_context=True, no_pm=True)
     async def volume(self, ctx, value : int):
@@ -190,25 +749,33 @@ class Music:
 
         state = self.get_voice_state(ctx.message.server)
         if state.is_playing():
-            player = state.player
-            player.volume = value / 100
-            await self.bot.say('Set the volume to {:.0%}'.format(player.volume))
+            entry = state.current
+            before = entry.volume
+            volume = entry.set_volume(value / 100)
+            if entry.stage is None and volume != before:
+                # encoded packets cannot be scaled, the song continues on the path that fits the new volume
+                state.replay()
+            state.status.note('{} set the volume to {:.0%}'.format(ctx.message.author.display_name, volume), ctx.message.channel)
 
     @commands.command(pass_context=True, no_pm=True)
     async def pause(self, ctx):
         """Pauses the currently played song."""
         state = self.get_voice_state(ctx.message.server)
-        if state.is_playing():
+        if state.is_playing() and state.player is not None:
             player = state.player
             player.pause()
+            state.current.pause()
+            state.status.update()
 
     @commands.command(pass_context=True, no_pm=True)
     async def resume(self, ctx):
         """Resumes the currently played song."""
         state = self.get_voice_state(ctx.message.server)
-        if state.is_playing():
+        if state.is_playing() and state.player is not None:
             player = state.player
             player.resume()
+            state.current.resume()
+            state.status.update()
 
     @commands.command(pass_context=True, no_pm=True)
     async def stop(self, ctx):
@@ -216,19 +783,7 @@ class Music:
 
         This also clears the queue.
         """
-        server = ctx.message.server
-        state = self.get_voice_state(server)
-
-        if state.is_playing():
-            player = state.player
-            player.stop()
-
-        try:
-            state.audio_player.cancel()
-            del self.voice_states[server.id]
-            await state.voice.disconnect()
-        except:
-            pass
+        await self.teardown(ctx.message.server.id)
 
     @commands.command(pass_context=True, no_pm=True)
     async def skip(self, ctx):
@@ -241,33 +796,140 @@ class Music:
             return
 
         voter = ctx.message.author
+        title = state.current.info.get('title')
         if voter == state.current.requester:
-            await self.bot.say('Requester requested skipping song...')
+            state.status.note('Requester skipped *{}*'.format(title), ctx.message.channel)
             state.skip()
         elif voter.server_permissions.administrator == True:
-            await self.bot.say('Admin requested skipping song...')
+            state.status.note('Admin {} skipped *{}*'.format(voter.display_name, title), ctx.message.channel)
             state.skip()
-        elif voter.id not in state.skip_votes:
-            state.skip_votes.add(voter.id)
-            total_votes = len(state.skip_votes)
+        elif voter.id not in state.current.skip_votes:
+            state.current.skip_votes.add(voter.id)
+            total_votes = len(state.current.skip_votes)
             if total_votes >= 3:
-                await self.bot.say('Skip vote passed, skipping song...')
+                state.status.note('Skip vote passed, skipped *{}*'.format(title), ctx.message.channel)
                 state.skip()
             else:
-                await self.bot.say('Skip vote added, currently at [{}/3]'.format(total_votes))
+                # the vote count is part of the status
+                state.status.update(ctx.message.channel)
         else:
             await self.bot.say('You have already voted to skip this song.')
 
     @commands.command(pass_context=True, no_pm=True)
     async def playing(self, ctx):
-        """Shows info about the currently played song."""
+        """Shows the status message again at the bottom of the channel."""
 
         state = self.get_voice_state(ctx.message.server)
-        if state.current is None:
-            await self.bot.say('Not playing anything.')
+        state.status.repost(ctx.message.channel)
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def queue(self, ctx, page : int = 1):
+        """Lists the queued songs, 10 per page."""
+
+        state = self.get_voice_state(ctx.message.server)
+        if state.songs.empty():
+            await self.bot.say('The queue is empty.')
+            return
+        pages = (len(state.songs) + 9) // 10
+        page = min(max(page, 1), pages)
+        length = sum(entry.info.get('duration') or 0 for entry in state.songs)
+        lines = ['{} songs queued [length: {}h {}m], page {}/{}:'.format(len(state.songs), *divmod(int(length) // 60, 60), page, pages)]
+        for position, entry in enumerate(state.songs.page(page), (page - 1) * 10 + 1):
+            lines.append('`{}.` *{}* requested by {}'.format(position, entry.info.get('title'), entry.requester.display_name))
+        await self.bot.say('\n'.join(lines))
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def remove(self, ctx, *, target : str):
+        """Removes the queued song at a position, or every song of a mentioned user.
+
+        Anyone can remove their own songs, admins can remove any.
+        """
+        state = self.get_voice_state(ctx.message.server)
+        author = ctx.message.author
+        admin = author.server_permissions.administrator
+        if ctx.message.mentions:
+            user = ctx.message.mentions[0]
+            if user != author and not admin:
+                await self.bot.say('Only admins can remove the songs of others.')
+                return
+            removed = state.songs.remove_by(user.id)
         else:
-            skip_count = len(state.skip_votes)
-            await self.bot.say('Now playing {} [skips: {}/3]'.format(state.current, skip_count))
+            try:
+                position = int(target)
+            except ValueError:
+                await self.bot.say('Give the position of a song or mention a user.')
+                return
+            if not 1 <= position <= len(state.songs):
+                await self.bot.say('There is no song at position {}.'.format(position))
+                return
+            if state.songs[position - 1].requester != author and not admin:
+                await self.bot.say('Only the requester or an admin can remove that song.')
+                return
+            removed = [state.songs.remove(position - 1)]
+        state.discard(removed)
+        state.status.note('{} removed {} songs from the queue'.format(author.display_name, len(removed)), ctx.message.channel)
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def move(self, ctx, source : int, target : int):
+        """Moves a queued song to another position."""
+
+        state = self.get_voice_state(ctx.message.server)
+        author = ctx.message.author
+        size = len(state.songs)
+        if not (1 <= source <= size and 1 <= target <= size):
+            await self.bot.say('Positions go from 1 to {}.'.format(size))
+            return
+        if state.songs[source - 1].requester != author and not author.server_permissions.administrator:
+            await self.bot.say('Only the requester or an admin can move that song.')
+            return
+        entry = state.songs.move(source - 1, target - 1)
+        state.reordered()
+        state.status.note('{} moved *{}* to position {}'.format(author.display_name, entry.info.get('title'), target), ctx.message.channel)
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def shuffle(self, ctx):
+        """Shuffles the queue.
+
+        Admins can always shuffle, others only when every queued song is theirs.
+        """
+        state = self.get_voice_state(ctx.message.server)
+        author = ctx.message.author
+        if state.songs.count(author.id) != len(state.songs) and not author.server_permissions.administrator:
+            await self.bot.say('Only admins can shuffle the songs of others.')
+            return
+        state.songs.shuffle()
+        state.reordered()
+        state.status.note('{} shuffled the queue'.format(author.display_name), ctx.message.channel)
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def gaps(self, ctx):
+        """Shows the silence between the last tracks."""
+
+        state = self.get_voice_state(ctx.message.server)
+        if not state.gaps:
+            await self.bot.say('No track changes measured yet.')
+        else:
+            gaps = sorted(state.gaps)
+            await self.bot.say('Gap between tracks over the last {}: avg {:.2f}s, median {:.2f}s, max {:.2f}s [look-ahead: {}]'.format(
+                len(gaps), sum(gaps) / len(gaps), gaps[len(gaps) // 2], gaps[-1], state.prefetch_depth))
+
+    @commands.command(pass_context=True)
+    async def streams(self, ctx):
+        """Shows what a stream costs on each playback path."""
+
+        costs = self.costs
+        lines = []
+        for path in ('passthrough', 'pooled', 'transcode', 'cached'):
+            per_core = costs.per_core(path)
+            if per_core is not None:
+                lines.append('{}: {} tracks, {:.1%} of a core per stream, {:.0f} streams per core'.format(
+                    path, costs.streams[path], 1 / per_core, per_core))
+        if not lines:
+            await self.bot.say('No finished tracks measured yet.')
+            return
+        if costs.incompatible:
+            lines.append('{} Opus tracks could not be passed through.'.format(costs.incompatible))
+        await self.bot.say('\n'.join(lines))
 			
             
     @commands.command(pass_context=True, no_pm=True)
@@ -275,11 +937,9 @@ class Music:
         """Plays "Με θυμασαι ρε πούστη"
        
         """
+        if await playRateLimited(self.bot, ctx.message):
+            return
         state = self.get_voice_state(ctx.message.server)
-        opts = {
-            'default_search': 'auto',
-            'quiet': True,
-        }
         
         song = "https://soundcloud.com/42mlg69u/y1nmvab5pr7t/s-vFELw"
 
@@ -289,16 +949,18 @@ class Music:
                 return
 
         try:
-            player = await state.voice.create_ytdl_player(song, ytdl_options=opts, after=state.toggle_next)
+            info = await self.resolver.resolve(song)
         except Exception as e:
             fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
             await self.bot.send_message(ctx.message.channel, fmt.format(type(e).__name__, e))
         else:
-            player.volume = 10000000
-            entry = VoiceEntry(ctx.message, player)
-            await self.bot.say('Enqueued ' + str(entry))
-            await state.songs.put(entry)
-            await self.stopAfter(ctx)
+            entry = VoiceEntry(ctx.message.author, ctx.message.channel, song, info, volume=MAX_VOLUME)
+            try:
+                await state.enqueue(entry)
+            except asyncio.QueueFull:
+                await self.bot.say(QUEUE_FULL)
+                return
+            state.prefetch()
 #---------------------------------------------------------------------------------------------------------------------------------------
 	
 	
@@ -306,17 +968,37 @@ class Music:
  
 def clog(*args):
     print(*args)
-    log = open("logs\clog.txt", "a")
-    for arg in args:
-        log.write(str(arg))
-    log.write("\n")
-    log.close
-	
-def findChannel(ch, n):
-    for channel in ch:
-        if channel.name == n:
-            return channel
-    return None			
+    eventLog.write("".join(str(arg) for arg in args))
+
+def startupPhases():
+    marks = startup
+    phases = collections.OrderedDict()
+    for name, begin, end in (("import", "import", "imported"), ("login", "login", "logged_in"), ("ready", "logged_in", "ready"), ("total", "import", "ready")):
+        if begin in marks and end in marks:
+            phases[name] = round(marks[end] - marks[begin], 3)
+    if "voice" in marks:
+        phases["voice"] = round(marks["voice"], 3)
+    return phases
+
+def reportStartup():
+    """Logs the time spent in each startup phase and appends it to logs/startup.jsonl."""
+    phases = startupPhases()
+    clog("Startup: ", ", ".join("{} {:.2f}s".format(name, value) for name, value in phases.items()))
+    record = {"at": datetime.datetime.utcnow().isoformat(), "release": os.environ.get("HEROKU_RELEASE_VERSION"), "shard": SHARD_ID, "phases": phases}
+    try:
+        with open(os.path.join("logs", "startup.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError:
+        pass
+
+async def warmUpVoice():
+    await asyncio.sleep(VOICE_WARMUP_DELAY)
+    try:
+        await musicBot.ensure_voice()
+    except Exception as e:
+        clog("Could not load voice support: ", type(e).__name__, ": ", e)
+    else:
+        clog("Voice support loaded in {:.2f}s".format(startup["voice"]))
 
 #---------------------------------------------------------------------------------------------------------------------------------------
 	
@@ -335,27 +1017,124 @@ async def rr(ctx):
         await client.kick(ctx.message.author)
     else:
         await client.say("Lucky motherfucker.")
+
+@commands.command(pass_context=True, no_pm=True)
+@commands.has_permissions(manage_server=True)
+async def auditchannel(ctx, channel : discord.Channel = None):
+    """Sets the channel audit logs are sent to.
+
+    Without a channel it falls back to the default one.
+    """
+    server = ctx.message.server
+    channels.set_audit_channel(server, channel)
+    ch = channels.audit_channel(server)
+    if ch is None:
+        await client.say("No audit channel found, audit logs are disabled.")
+    else:
+        await client.say("Audit logs will be sent to " + ch.mention)
+
+def isOwner(ctx):
+    return OWNER_ID is not None and ctx.message.author.id == OWNER_ID
+
+@commands.command(name="metrics")
+@commands.check(isOwner)
+async def showMetrics():
+    """Shows command, event and loop latencies."""
+    lines = ["{:<20} {:>7} {:>9} {:>9} {:>9}".format("", "count", "p50 ms", "p99 ms", "max ms")]
+    for name in ("command_seconds", "event_seconds", "resolve_seconds", "loop_lag_seconds"):
+        rows = metrics.summary(name)
+        if rows:
+            lines.append("[" + name + "]")
+            lines.extend(rows)
+    queued = sum(state.songs.qsize() for state in musicBot.voice_states.values())
+    lines.append("voice states: {} | queued: {} | log drops: {}".format(len(musicBot.voice_states), queued, chatLog.dropped + eventLog.dropped))
+    await client.say("```\n" + "\n".join(lines)[:1900] + "\n```")
+
+@commands.command(pass_context=True)
+@commands.check(isOwner)
+async def profile(ctx, action : str = "stop"):
+    """Starts or stops the sampling profiler of the event loop."""
+    if action == "start":
+        if profiler.start():
+            await client.say("Profiler started.")
+        else:
+            await client.say("The profiler is already running.")
+        return
+
+    path = os.path.join("logs", "profile-{}.folded".format(int(time.time())))
+    report = profiler.stop(path)
+    if report is None:
+        await client.say("The profiler is not running.")
+    else:
+        await client.send_file(ctx.message.channel, io.BytesIO(report.encode("utf-8")), filename="profile.txt", content="Collapsed stacks saved to " + path)
+
+@commands.command(pass_context=True, no_pm=True)
+@commands.has_permissions(manage_messages=True)
+async def search(ctx, *, query : str = ""):
+    """Searches the message log, newest first.
+
+    Mention a user or a channel to narrow it down, user:ID finds users that
+    left. after:YYYY-MM-DD and before:YYYY-MM-DD limit the time, every other
+    word has to appear in the message.
+    """
+    message = ctx.message
+    author = message.mentions[0].id if message.mentions else None
+    channel = message.channel_mentions[0].id if message.channel_mentions else None
+    after = before = None
+    words = []
+    for word in query.split():
+        if word.startswith("<@") or word.startswith("<#"):
+            continue
+        key, _, value = word.partition(":")
+        try:
+            if key == "after":
+                after = datetime.datetime.strptime(value, "%Y-%m-%d")
+                continue
+            if key == "before":
+                before = datetime.datetime.strptime(value, "%Y-%m-%d")
+                continue
+        except ValueError:
+            await client.say("Dates are written like 2018-01-31.")
+            return
+        if key == "user" and value.isdigit():
+            author = value
+            continue
+        words.append(word)
+
+    started = time.perf_counter()
+    rows = await client.loop.run_in_executor(None, lambda: messageLog.search(message.server.id, author, channel, after, before, " ".join(words)))
+    took = time.perf_counter() - started
+    if not rows:
+        await client.say("No messages found ({:.0f}ms).".format(took * 1000))
+        return
+
+    out = "{} newest messages ({:.0f}ms):".format(len(rows), took * 1000)
+    for id, channel_id, author_id, name, content in rows:
+        # no mention in a result should ping anyone
+        line = "\n`{:%Y-%m-%d %H:%M}` <#{}> **{}**: {}".format(snowflakeTime(id), channel_id, name, content[:300].replace("@", "@\u200b"))
+        if len(out) + len(line) > 2000:
+            break
+        out += line
+    await client.say(out)
+
+@commands.command()
+async def auditstats():
+    """Shows how many audit events were sent, merged or dropped."""
+    st = auditLog.stats
+    await client.say("Audit events: {} | messages sent: {} | merged: {} | dropped: {} | failed: {}".format(st['events'], st['sent'], st['merged'], st['dropped'], st['failed']))
+    await client.say("Messages kept for auditing: {} in {:.1f}MB, {} evicted".format(len(messages), messages.size / 1024 / 1024, messages.evicted))
 	
 #---------------------------------------------------------------------------------------------------------------------------------------
 	
 async def gameChanger():
     await client.wait_until_ready()
     while not client.is_closed:
-        
-
-        activeServers = client.servers
-        memberList = []
-        
-        for s in activeServers:
-            for user in s.members:
-                if user.status != discord.Status.offline:
-                    memberList.append(user.display_name)
-                
-       
-        try:
-            await client.change_presence(game=discord.Game(name="with " + random.choice(memberList) + "'s dick", type = 0))
-        except:
-            pass
+        member = online.choice()
+        if member is not None:
+            try:
+                await client.change_presence(game=discord.Game(name="with " + member.display_name + "'s dick", type = 0))
+            except:
+                pass
         
         await asyncio.sleep(30)
 
@@ -363,13 +1142,17 @@ async def gameChanger():
 		
         
 @client.event
+@metrics.timed("event_seconds", event="on_member_join")
 async def on_member_join(member):
-    return None
+    online.update(member)
     
 @client.event
+@metrics.timed("event_seconds", event="on_member_remove")
 async def on_member_remove(member):
-    ser = member.server
-    ch = findChannel(ser.channels, "bot")
+    online.discard(member)
+    ch = channels.audit_channel(member.server)
+    if ch is None:
+        return
     emb = discord.Embed(description = member.mention + " " + str(member), color = 0xdd10dd, timestamp = datetime.datetime.now())
     
     if member.avatar_url != "":
@@ -379,97 +1162,153 @@ async def on_member_remove(member):
         
     emb.set_footer(text = ("ID: " + str(member.id)))
     
-    await client.send_message(ch, embed = emb)
+    auditLog.post(ch, emb)
     
-@client.event
-async def on_message_delete(message):
+def messageAuthor(server, author_id):
+    """Mention, name and avatar of a message author who may have left the server."""
+    member = server.get_member(author_id)
+    if member is None:
+        return "<@" + author_id + ">", author_id, ""
+    return member.mention, str(member), member.avatar_url
+
+@metrics.timed("event_seconds", event="on_message_delete")
+async def auditDelete(server, message_id):
+    message = messages.pop(server.id, message_id)
+    if message is None:
+        return
+    ch = channels.audit_channel(server)
+    if ch is None:
+        return
+
+    mention, name, avatar = messageAuthor(server, message.author_id)
+    emb = discord.Embed(description = "**Message sent by " + mention  + " deleted in <#" + message.channel_id + ">**\n" + message.content[:] , color = 0xdd10dd, timestamp = datetime.datetime.now())
+    emb.set_author(name = name, icon_url = avatar)
+    emb.set_footer(text = ("ID: " + message.author_id))
+
+    auditLog.post(ch, emb)
+
+@metrics.timed("event_seconds", event="on_message_edit")
+async def auditEdit(server, message_id, content):
+    before = messages.edit(server.id, message_id, content)
+    # embeds being added to a message also arrive as updates
+    if before is None or before == content:
+        return
+    ch = channels.audit_channel(server)
+    if ch is None:
+        return
+
+    message = messages.get(server.id, message_id)
+    mention, name, avatar = messageAuthor(server, message.author_id)
+    emb = discord.Embed(description = "**Message edited in <#" + message.channel_id + ">**" , color = 0xdd10dd, timestamp = datetime.datetime.now())
+    emb.add_field(name = "Before", value = before[:], inline = False)
+    emb.add_field(name = "After", value = content[:], inline = False)
+    emb.set_author(name = name, icon_url = avatar)
+    emb.set_footer(text = ("ID: " + message.author_id))
+
+    auditLog.post(ch, emb)
 
-    if message.embeds == []:
-    
-        member = message.author
-        ser = member.server
-        ch = findChannel(ser.channels, "bot")
-	
-        emb = discord.Embed(description = "**Message sent by " + str(member.mention)  + "deleted in " + str(message.channel.mention) + "**\n" + message.content[:] , color = 0xdd10dd, timestamp = datetime.datetime.now())
-        emb.set_author(name = str(member), icon_url = member.avatar_url)
-        emb.set_footer(text = ("ID: " + str(member.id)))
-        
-        await client.send_message(ch, embed = emb)
-		
 @client.event
-async def on_message_edit(before, after):
-
-    if before.embeds == [] and after.embeds == []:
-    
-        member = before.author
-        ser = member.server
-        ch = findChannel(ser.channels, "bot")
-	
-        emb = discord.Embed(description = "**Message edited in " + str(before.channel.mention) + "**" , color = 0xdd10dd, timestamp = datetime.datetime.now())
-        emb.add_field(name = "Before", value = before.content[:], inline = False)
-        emb.add_field(name = "After", value = after.content[:], inline = False)
-        emb.set_author(name = str(member), icon_url = member.avatar_url)
-        emb.set_footer(text = ("ID: " + str(member.id)))
-        
-        await client.send_message(ch, embed = emb)
+async def on_socket_response(msg):
+    # deletes and edits are taken from the raw gateway events, on_message_delete
+    # and on_message_edit only fire for messages in the library's cache
+    event = msg.get('t')
+    if event not in ('MESSAGE_DELETE', 'MESSAGE_DELETE_BULK', 'MESSAGE_UPDATE'):
+        return
+    data = msg['d']
+    server = client.get_server(data.get('guild_id'))
+    if server is None:
+        return
+
+    if event == 'MESSAGE_DELETE':
+        await auditDelete(server, data['id'])
+    elif event == 'MESSAGE_DELETE_BULK':
+        for message_id in data['ids']:
+            await auditDelete(server, message_id)
+    elif 'content' in data:
+        await auditEdit(server, data['id'], data['content'])
 
 @client.event
+@metrics.timed("event_seconds", event="on_member_update")
 async def on_member_update(before, after):
 
+    online.update(after)
     member = before
-    ser = member.server
-    ch = findChannel(ser.channels, "bot")
-    
-    broles = before.roles[1:]
-    aroles = after.roles[1:]
-    
     bnick = str(before.nick)
     anick = str(after.nick)
-    
-    if before.roles[0].is_everyone and not after.roles[0].is_everyone:
-        emb = discord.Embed(description = str(before.mention) + "**was given the " + str(after.roles[0]) + " role**" , color = 0xdd10dd, timestamp = datetime.datetime.now())
-        emb.set_author(name=str(member), icon_url=member.avatar_url)
-        emb.set_footer(text=("ID: " + str(member.id)))
-                
-        await client.send_message(ch, embed=emb)
-        
-    elif after.roles[0].is_everyone and not before.roles[0].is_everyone:
-        emb = discord.Embed(description =  str(before.mention) + "**was removed from the " + str(before.roles[0]) + " role**" , color = 0xdd10dd, timestamp = datetime.datetime.now())
-        emb.set_author(name = str(member), icon_url = member.avatar_url)
-        emb.set_footer(text = ("ID: " + str(member.id)))
-                
-        await client.send_message(ch, embed = emb)
-        
-    else:   
-        for roleb in broles:
-            for rolea in aroles:
-                if rolea not in broles:
-                    emb = discord.Embed(description = str(before.mention) + "**was given the " + str(rolea) + " role**" , color = 0xdd10dd, timestamp = datetime.datetime.now())
-                    emb.set_author(name=str(member), icon_url=member.avatar_url)
-                    emb.set_footer(text=("ID: " + str(member.id)))
-                    
-                    await client.send_message(ch, embed=emb)
-                    
-                if roleb not in aroles:
-                    emb = discord.Embed(description =  str(before.mention) + "**was removed from the " + str(roleb) + " role**" , color = 0xdd10dd, timestamp = datetime.datetime.now())
-                    emb.set_author(name = str(member), icon_url = member.avatar_url)
-                    emb.set_footer(text = ("ID: " + str(member.id)))
-                    
-                    await client.send_message(ch, embed = emb)
 
+    if bnick == anick and before.roles == after.roles:
+        return
+
+    ch = channels.audit_channel(member.server)
+    if ch is None:
+        return
 
+    given, removed = roleDiff(before.roles, after.roles)
+    if not given and not removed and bnick == anick:
+        return
+
+    emb = discord.Embed(description = str(member.mention) + " **was updated**" , color = 0xdd10dd, timestamp = datetime.datetime.now())
+    if given:
+        emb.add_field(name = "Given", value = ", ".join(str(role) for role in given)[:1024], inline = False)
+    if removed:
+        emb.add_field(name = "Removed", value = ", ".join(str(role) for role in removed)[:1024], inline = False)
     if bnick != anick:
-        emb = discord.Embed(description = str(member.mention) + " **nickname changed**" , color = 0xdd10dd, timestamp = datetime.datetime.now())
-        emb.add_field(name = "Before", value = bnick, inline = False)
-        emb.add_field(name = "After", value = anick, inline = False)
-        emb.set_author(name = str(member), icon_url = member.avatar_url)
-        emb.set_footer(text = ("ID: " + str(member.id)))
-        
-        await client.send_message(ch, embed = emb)
+        emb.add_field(name = "Nickname", value = bnick + " -> " + anick, inline = False)
+    emb.set_author(name = str(member), icon_url = member.avatar_url)
+    emb.set_footer(text = ("ID: " + str(member.id)))
+
+    auditLog.post(ch, emb)
     
 
 @client.event
+@metrics.timed("event_seconds", event="on_server_join")
+async def on_server_join(server):
+    channels.add_server(server)
+    online.add_server(server)
+
+@client.event
+@metrics.timed("event_seconds", event="on_server_remove")
+async def on_server_remove(server):
+    channels.remove_server(server)
+    online.remove_server(server)
+    messages.remove_server(server.id)
+
+@client.event
+@metrics.timed("event_seconds", event="on_channel_create")
+async def on_channel_create(channel):
+    channels.add(channel)
+
+@client.event
+@metrics.timed("event_seconds", event="on_channel_delete")
+async def on_channel_delete(channel):
+    channels.remove(channel)
+
+@client.event
+@metrics.timed("event_seconds", event="on_channel_update")
+async def on_channel_update(before, after):
+    channels.update(before, after)
+
+@client.event
+async def on_command_error(error, ctx):
+    print('Ignoring exception in command {}'.format(ctx.command), file=sys.stderr)
+    traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+
+@client.event
+@metrics.timed("event_seconds", event="on_ready")
 async def on_ready():
+    for server in client.servers:
+        channels.add_server(server)
+        online.add_server(server)
+
+    global OWNER_ID
+    if OWNER_ID is None:
+        OWNER_ID = (await client.application_info()).owner.id
+
+    if "ready" not in startup:
+        startup["ready"] = time.perf_counter()
+        reportStartup()
+        client.loop.create_task(warmUpVoice())
+        client.loop.create_task(musicBot.restore_queues())
 
     clog("Bot is ready!")
     clog('Logged in as')
@@ -483,6 +1322,7 @@ async def on_ready():
 	
 
 @client.event
+@metrics.timed("event_seconds", event="on_message")
 async def on_message(message):
 
     userID = message.author.id
@@ -497,18 +1337,20 @@ async def on_message(message):
         #log.write("OOF")
         #pass
         
-    if message.author.name != "Rythm":
-    
-        log = open("logs\log.txt", "a")
-        log.write("#")
-        log.write(message.channel.name)
-        log.write(":")
-        log.write(userName)
-        log.write(":")
-        log.write(message.content[:])
-        log.write("\n")
-        log.close
-		
+    # the bot's own messages are not audited, the status message alone is edited every few seconds
+    if message.server is not None and message.embeds == [] and message.author.id != client.user.id:
+        messages.add(message.server.id, message)
+
+    if userID not in IGNORED_USERS:
+        chatLog.write("#" + str(message.channel.name) + ":" + userName + ":" + message.content)
+        if message.server is not None:
+            messageLog.add(message)
+
+    # most messages are not commands, only those with the prefix are parsed
+    if message.content.startswith(PREFIX):
+        if userID not in BLOCKED_USERS:
+            await client.process_commands(message)
+        return
         
     if message.content == "Ενταξεί.":
         auth = message.author
@@ -567,16 +1409,71 @@ async def on_message(message):
         # else:
             # clog("You dont have permission to timeout.")
             
-    if message.author.name != "Zedal/(cosplay.kotaku.com)":
-        await client.process_commands(message)
 	
 #---------------------------------------------------------------------------------------------------------------------------------------
 	
-token = os.environ['TOKEN']
 musicBot = Music(client)
 
 client.add_command(rr)
+client.add_command(auditchannel)
+client.add_command(auditstats)
+
+client.add_command(showMetrics)
+client.add_command(profile)
+client.add_command(search)
 
 client.add_cog(musicBot)
-client.loop.create_task(gameChanger())
-client.run(token)
+
+metrics.instrument_commands(client)
+metrics.gauge("voice_states", lambda: len(musicBot.voice_states))
+metrics.gauge("voice_connect_total", lambda: dict(musicBot.connector.stats), label="kind")
+metrics.gauge("voice_connect_waiting", lambda: musicBot.connector.waiting)
+metrics.gauge("stream_cpu_seconds_total", lambda: dict(musicBot.costs.cpu), label="path")
+metrics.gauge("stream_audio_seconds_total", lambda: dict(musicBot.costs.audio), label="path")
+metrics.gauge("transcoder_streams", lambda: musicBot.transcoders.streams if musicBot.transcoders is not None else 0)
+metrics.gauge("status_messages_total", lambda: dict(StatusMessage.totals), label="kind")
+metrics.gauge("voice_queue_depth", lambda: {sid: state.songs.qsize() for sid, state in musicBot.voice_states.items()}, label="server")
+metrics.gauge("online_members", lambda: len(online))
+metrics.gauge("audit_events_total", lambda: dict(auditLog.stats), label="kind")
+metrics.gauge("resolver_total", lambda: dict(musicBot.resolver.stats), label="kind")
+metrics.gauge("startup_seconds", startupPhases, label="phase")
+metrics.gauge("play_rejected_total", lambda: playCooldown.rejected)
+metrics.gauge("message_log_total", lambda: {"written": messageLog.written, "dropped": messageLog.dropped, "pruned": messageLog.pruned}, label="kind")
+metrics.gauge("log_dropped_total", lambda: {"chat": chatLog.dropped, "event": eventLog.dropped}, label="log")
+
+startup["imported"] = time.perf_counter()
+
+def main():
+    token = os.environ['TOKEN']
+
+    login = client.login
+    async def timedLogin(*args, **kwargs):
+        startup["login"] = time.perf_counter()
+        await login(*args, **kwargs)
+        startup["logged_in"] = time.perf_counter()
+    client.login = timedLogin
+
+    client.loop.create_task(gameChanger())
+    client.loop.create_task(metrics.monitor_lag())
+    if METRICS_PORT:
+        client.loop.run_until_complete(metrics.serve(METRICS_HOST, METRICS_PORT))
+    # Heroku and the shard supervisor stop the bot with SIGTERM, client.run only handles Ctrl+C
+    try:
+        client.loop.add_signal_handler(signal.SIGTERM, lambda: client.loop.create_task(client.logout()))
+    except NotImplementedError: # Windows
+        pass
+    try:
+        client.run(token)
+    finally:
+        auditLog.close()
+        musicBot.journal.close()
+        musicBot.gains.save()
+        if musicBot.transcoders is not None:
+            musicBot.transcoders.close()
+        messageLog.close()
+        chatLog.close()
+        eventLog.close()
+
+if __name__ == "__main__":
+    main()
+
@@ -0,0 +1,262 @@
+import collections, concurrent.futures, discord, hashlib, mmap, os, struct, subprocess, threading, time
+from resolver import FFMPEG_BEFORE
+from pcm import PCMStage
+
+MAGIC = b'OPUSFRM2' # frames are normalized and at the cache's volume, OPUSFRM1 files were not
+FRAME = struct.Struct('>H')
+
+SAMPLING_RATE = 48000
+CHANNELS = 2
+FRAME_SAMPLES = 960 # 20ms
+FRAME_BYTES = FRAME_SAMPLES * CHANNELS * 2
+
+
+def trackKey(info):
+    """Content address of a track, stable across stream URL changes."""
+    ident = '{}:{}'.format(info.get('extractor'), info.get('id') or info.get('webpage_url'))
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+
+def pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def readFrames(path, skip=0):
+    """Yields the Opus packets of a cache file, reading it through mmap.
+
+    The first `skip` packets are passed over, 50 make up a second.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[:len(MAGIC)] != MAGIC:
+            return
+        pos = len(MAGIC)
+        end = len(data)
+        while pos + FRAME.size <= end:
+            size, = FRAME.unpack_from(data, pos)
+            pos += FRAME.size
+            if skip:
+                skip -= 1
+            else:
+                yield data[pos:pos + size]
+            pos += size
+    finally:
+        data.close()
+
+
+class AudioCache:
+    """Size-bounded on-disk cache of encoded Opus frames.
+
+    A track is encoded once it has been played `min_plays` times and its
+    normalization gain is known, through the same PCM stage as transcoded
+    playback at `volume`, so a cached track sounds as loud as it would
+    from the stream. Files are named after trackKey() and evicted least
+    recently used first when the files this cache knows of grow past
+    max_bytes. Last use is kept in the file's mtime so the order survives
+    restarts. The folder is only scanned by load(), until then every
+    lookup misses.
+
+    Shard processes share the folder, each with its own max_bytes share.
+    A file another shard stored is picked up by the first lookup that
+    misses it. An encode in progress holds `<key>.opus.lock`, created
+    exclusively, and writes to a temporary file named after its process.
+    """
+    def __init__(self, folder, max_bytes=1024 * 1024 * 1024, min_plays=2, max_duration=15 * 60, workers=1, volume=1.0):
+        self.folder = folder
+        self.volume = volume
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_duration = max_duration
+        self.stats = collections.Counter()
+        self._plays = collections.Counter()
+        self._pending = set()
+        self._files = collections.OrderedDict() # key -> size, least recently used first
+        self._lock = threading.Lock() # encodes finish on the worker thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.loaded = False
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.opus')
+
+    def load(self):
+        if self.loaded:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        self._scan()
+        self.loaded = True
+
+    def _scan(self):
+        found = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if name.endswith(('.tmp', '.lock')):
+                    # left behind by a process that died while encoding, other shards' are in progress
+                    owner = self._owner(path, name)
+                    if owner is None or (owner and not pidAlive(owner)):
+                        os.remove(path)
+                elif name.endswith('.opus'):
+                    if not self._current(path):
+                        os.remove(path)
+                        continue
+                    st = os.stat(path)
+                    found.append((st.st_mtime, name[:-5], st.st_size))
+            except FileNotFoundError:
+                pass # another shard finished or evicted it meanwhile
+        with self._lock:
+            for mtime, key, size in sorted(found):
+                self._files[key] = size
+        self._evict()
+
+    @staticmethod
+    def _owner(path, name):
+        """Process id of a temporary or lock file, None if it has none."""
+        try:
+            if name.endswith('.tmp'):
+                # <key>.opus.<pid>.tmp
+                return int(name.rsplit('.', 2)[1])
+            with open(path, encoding='ascii') as f:
+                pid = f.read()
+            if not pid:
+                # still being written, or its process died right after creating it
+                return 0 if time.time() - os.path.getmtime(path) < 60 else None
+            return int(pid)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _current(path):
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(self._files.values())
+
+    def lookup(self, info):
+        """Returns the cache file of the track or None."""
+        key = trackKey(info)
+        path = self._path(key)
+        with self._lock:
+            if key in self._files:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    del self._files[key]
+                else:
+                    self._files.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return path
+        if self.loaded and os.path.exists(path):
+            # stored by another shard
+            try:
+                os.utime(path)
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            else:
+                with self._lock:
+                    self._files[key] = size
+                self.stats['hits'] += 1
+                self.stats['adopted'] += 1
+                self._evict()
+                return path
+        self.stats['misses'] += 1
+        return None
+
+    def note_play(self, info, gain=None):
+        """Counts a play of an uncached track and encodes it once it is popular and `gain` is known."""
+        if not self.loaded or info.get('is_live') or (info.get('duration') or 0) > self.max_duration:
+            return
+        key = trackKey(info)
+        self._plays[key] += 1
+        if self._plays[key] >= self.min_plays and gain is not None and key not in self._files and key not in self._pending:
+            self._pending.add(key)
+            future = self._executor.submit(self._encode, key, info, gain)
+            future.add_done_callback(lambda f: self._encoded(key, f))
+
+    def _encoded(self, key, future):
+        # runs on the worker thread
+        self._pending.discard(key)
+        if future.exception() is not None:
+            self.stats['failed'] += 1
+            return
+        self._plays.pop(key, None)
+        if future.result() is None:
+            self.stats['busy'] += 1 # another shard is encoding it
+            return
+        with self._lock:
+            self._files[key] = future.result()
+        self.stats['stored'] += 1
+        self._evict()
+
+    def _encode(self, key, info, gain):
+        args = ['ffmpeg'] + FFMPEG_BEFORE.split()
+        for name, value in (info.get('http_headers') or {}).items():
+            args += ['-headers', '{}: {}\r\n'.format(name, value)]
+        args += ['-i', info['url'], '-f', 's16le', '-ar', str(SAMPLING_RATE), '-ac', str(CHANNELS),
+                 '-loglevel', 'warning', 'pipe:1']
+
+        lock = self._path(key) + '.lock'
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return None
+        try:
+            os.write(fd, str(os.getpid()).encode('ascii'))
+            os.close(fd)
+            if os.path.exists(self._path(key)):
+                return None # stored by another shard since it was looked up
+            return self._encode_locked(key, args, gain)
+        finally:
+            os.remove(lock)
+
+    def _encode_locked(self, key, args, gain):
+        encoder = discord.opus.Encoder(SAMPLING_RATE, CHANNELS)
+        tmp = '{}.{}.tmp'.format(self._path(key), os.getpid())
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        stage = PCMStage(process.stdout, self.volume, gain)
+        try:
+            with open(tmp, 'wb') as out:
+                out.write(MAGIC)
+                while True:
+                    pcm = stage.read(FRAME_BYTES)
+                    if len(pcm) < FRAME_BYTES:
+                        break
+                    packet = encoder.encode(pcm, FRAME_SAMPLES)
+                    out.write(FRAME.pack(len(packet)))
+                    out.write(packet)
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, args[0])
+            os.replace(tmp, self._path(key))
+        except:
+            process.kill()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return os.path.getsize(self._path(key))
+
+    def _evict(self):
+        total = self.size
+        while total > self.max_bytes:
+            with self._lock:
+                if not self._files:
+                    break
+                key, size = self._files.popitem(last=False)
+            total -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self.stats['evicted'] += 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
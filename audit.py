@@ -0,0 +1,234 @@
+import asyncio, collections, datetime, discord, json, os
+from ratelimit import TokenBucket
+
+
+class ChannelIndex:
+    """Name and ID index of every server's text channels.
+
+    Built once per server and kept current from the channel create, delete
+    and update events, so the audit handlers never walk server.channels.
+    """
+    def __init__(self, default='bot', path=None):
+        self.default = default
+        self.path = path
+        self.overrides = {} # server.id -> channel.id of the audit channel
+        self._names = {}
+        self._ids = {}
+        self._load()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.overrides = json.load(f)
+        except (OSError, ValueError):
+            # a corrupt file must not keep the bot from starting, the overrides stay as they were
+            return
+
+    def _save(self):
+        if self.path is None:
+            return
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.overrides, f)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _indexable(channel):
+        return not channel.is_private and channel.type == discord.ChannelType.text
+
+    def add_server(self, server):
+        self._names[server.id] = {}
+        self._ids[server.id] = {}
+        for channel in server.channels:
+            self.add(channel)
+
+    def remove_server(self, server):
+        self._names.pop(server.id, None)
+        self._ids.pop(server.id, None)
+
+    def add(self, channel):
+        if not self._indexable(channel):
+            return
+        server_id = channel.server.id
+        if server_id not in self._ids:
+            self.add_server(channel.server)
+            return
+        self._ids[server_id][channel.id] = channel
+        self._names[server_id].setdefault(channel.name, channel)
+
+    def remove(self, channel):
+        if not self._indexable(channel):
+            return
+        ids = self._ids.get(channel.server.id)
+        if ids is None:
+            return
+        ids.pop(channel.id, None)
+        names = self._names[channel.server.id]
+        current = names.get(channel.name)
+        if current is not None and current.id == channel.id:
+            del names[channel.name]
+            # another channel may share the name, promote it
+            for other in ids.values():
+                if other.name == channel.name:
+                    names[channel.name] = other
+                    break
+
+    def update(self, before, after):
+        self.remove(before)
+        self.add(after)
+
+    def get(self, server, name):
+        return self._names.get(server.id, {}).get(name)
+
+    def get_by_id(self, server, channel_id):
+        return self._ids.get(server.id, {}).get(channel_id)
+
+    def audit_channel(self, server):
+        """Returns the configured audit channel for the server or None."""
+        channel_id = self.overrides.get(server.id)
+        if channel_id is not None:
+            channel = self.get_by_id(server, channel_id)
+            if channel is not None:
+                return channel
+        return self.get(server, self.default)
+
+    def set_audit_channel(self, server, channel):
+        # other shard processes may have written their own servers since we loaded
+        self._load()
+        if channel is None:
+            self.overrides.pop(server.id, None)
+        else:
+            self.overrides[server.id] = channel.id
+        self._save()
+
+
+def roleDiff(before, after):
+    """Returns the (added, removed) roles between two role lists.
+
+    The @everyone role is ignored wherever it appears in either list.
+    """
+    broles = {role.id: role for role in before if not role.is_everyone}
+    aroles = {role.id: role for role in after if not role.is_everyone}
+    added = [aroles[i] for i in aroles.keys() - broles.keys()]
+    removed = [broles[i] for i in broles.keys() - aroles.keys()]
+    added.sort(key=lambda role: role.position, reverse=True)
+    removed.sort(key=lambda role: role.position, reverse=True)
+    return added, removed
+
+
+def _text(value):
+    if value is discord.Embed.Empty or value is None:
+        return ''
+    return str(value)
+
+
+class AuditPipeline:
+    """Queues audit embeds per audit channel and sends them in batches.
+
+    post() returns immediately. The first event for a channel opens a short
+    window, every event that arrives during it is packed into as few messages
+    as the embed limits allow. Sends follow a token bucket mirroring
+    Discord's per-channel message route limit (5 messages per 5 seconds).
+    """
+    MAX_FIELDS = 25
+    MAX_TOTAL = 5800
+    MAX_VALUE = 1024
+
+    def __init__(self, client, window=1.5, max_pending=250, rate=5, per=5.0):
+        self.client = client
+        self.window = window
+        self.max_pending = max_pending
+        self.rate = rate
+        self.per = per
+        self.stats = collections.Counter()
+        self._pending = {}
+        self._buckets = {}
+        self._tasks = {}
+
+    def post(self, channel, embed):
+        pending = self._pending.get(channel.id)
+        if pending is None:
+            pending = self._pending[channel.id] = collections.deque()
+        if len(pending) >= self.max_pending:
+            pending.popleft()
+            self.stats['dropped'] += 1
+        pending.append(embed)
+        self.stats['events'] += 1
+
+        if channel.id not in self._tasks:
+            self._tasks[channel.id] = self.client.loop.create_task(self._drain(channel))
+
+    def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+    def _bucket(self, channel):
+        bucket = self._buckets.get(channel.id)
+        if bucket is None:
+            bucket = self._buckets[channel.id] = TokenBucket(self.rate, self.per)
+        return bucket
+
+    async def _drain(self, channel):
+        try:
+            await asyncio.sleep(self.window)
+            pending = self._pending[channel.id]
+            bucket = self._bucket(channel)
+            while pending:
+                delay = bucket.delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                bucket.take()
+                embed, count = self.merge(pending)
+                if count > 1:
+                    self.stats['merged'] += count
+                try:
+                    await self.client.send_message(channel, embed=embed)
+                    self.stats['sent'] += 1
+                except discord.HTTPException:
+                    self.stats['failed'] += count
+        finally:
+            self._tasks.pop(channel.id, None)
+            if not self._pending.get(channel.id):
+                self._pending.pop(channel.id, None)
+                if self._bucket(channel).full():
+                    self._buckets.pop(channel.id, None)
+
+    def merge(self, pending):
+        """Pops as many embeds as fit in one message and returns (embed, count)."""
+        first = pending.popleft()
+        if not pending:
+            return first, 1
+
+        merged = discord.Embed(color = first.color, timestamp = datetime.datetime.now())
+        total = 0
+        count = 0
+        item = first
+        while True:
+            name = _text(item.author.name) or 'Audit'
+            lines = [_text(item.description)]
+            for field in item.fields:
+                lines.append('**' + _text(field.name) + ':** ' + _text(field.value))
+            lines.append(_text(item.footer.text))
+            value = '\n'.join(line for line in lines if line)[:self.MAX_VALUE] or '-'
+            name = name[:256]
+
+            if count and total + len(name) + len(value) > self.MAX_TOTAL:
+                pending.appendleft(item)
+                break
+            merged.add_field(name = name, value = value, inline = False)
+            total += len(name) + len(value)
+            count += 1
+
+            if count >= self.MAX_FIELDS or not pending:
+                break
+            item = pending.popleft()
+
+        merged.set_footer(text = '{} audit events'.format(count))
+        return merged, count
@@ -0,0 +1,491 @@
+"""Offline load test of DiscordBot's event handlers and Music commands.
+
+Imports the real bot module, swaps every call that would reach Discord for a
+local stand-in (sends, edits, presence changes, voice connections) and
+replays a synthetic event stream at a fixed rate. The voice stand-in
+accepts the frames of the real FramePlayer. Transcoded tracks are a tone
+that a small script writes in place of ffmpeg, encoded by the real
+transcoder pool. youtube_dl extraction is replaced by a fixed delay inside
+the real resolver pool.
+
+    python3 bench/loadtest.py --rate 500 --duration 20 --servers 10
+
+Reports throughput, p50/p99 latency per handler, event loop lag, memory
+and the silence between back to back tracks. Every fake stream takes
+--connect-delay seconds to its first audio, --prefetch overrides
+PREFETCH_DEPTH to compare the gaps with and without look-ahead.
+"""
+import argparse, array, asyncio, collections, gc, math, os, random, resource, sys, tempfile, threading, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import discord
+
+#Stand-ins
+
+class FakeRole:
+    def __init__(self, id, name, position, is_everyone=False):
+        self.id = id
+        self.name = name
+        self.position = position
+        self.is_everyone = is_everyone
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeChannel:
+    def __init__(self, id, name, server, type=discord.ChannelType.text):
+        self.id = id
+        self.name = name
+        self.server = server
+        self.type = type
+        self.is_private = False
+        self.mention = '<#' + id + '>'
+
+
+class FakeMember:
+    def __init__(self, id, name, server, roles, voice_channel=None):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.nick = None
+        self.mention = '<@' + id + '>'
+        self.avatar_url = ''
+        self.default_avatar_url = 'https://cdn.discordapp.com/embed/avatars/0.png'
+        self.server = server
+        self.roles = roles
+        self.status = discord.Status.online
+        self.voice_channel = voice_channel
+        self.server_permissions = discord.Permissions.none()
+        self.bot = False
+
+    def copy(self):
+        member = FakeMember(self.id, self.name, self.server, list(self.roles), self.voice_channel)
+        member.nick = self.nick
+        return member
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name + '#0001'
+
+
+class FakeServer:
+    def __init__(self, id, members, roles):
+        self.id = id
+        self.name = 'server' + id
+        self.roles = [FakeRole(id, '@everyone', 0, True)] + [FakeRole(id + '-' + str(i), 'role' + str(i), i + 1) for i in range(roles)]
+        # numeric like Discord's snowflakes, the message log stores them as integers
+        base = (int(id) + 1) * 10 ** 7
+        self.channels = [FakeChannel(str(base + i), 'chat' + str(i), self) for i in range(20)]
+        self.channels.append(FakeChannel(str(base + 20), 'bot', self))
+        self.voice = FakeChannel(str(base + 21), 'music', self, discord.ChannelType.voice)
+        self.channels.append(self.voice)
+        self.members = [FakeMember(str(base + 10 ** 6 + i), 'user' + str(i), self, self.roles[:1], self.voice) for i in range(members)]
+        self._members = {member.id: member for member in self.members}
+
+    def get_member(self, id):
+        return self._members.get(id)
+
+    def get_member_named(self, name):
+        return None
+
+
+class FakeMessage:
+    _ids = 0
+
+    def __init__(self, content, author, channel):
+        FakeMessage._ids += 1
+        self.id = str(FakeMessage._ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.server = getattr(channel, 'server', None)
+        self.embeds = []
+        self.mentions = []
+        self.channel_mentions = []
+        self.role_mentions = []
+        self.timestamp = time.time()
+
+
+# one 20ms stereo frame of a 500Hz tone at -20 dBFS
+TONE = array.array('h', (int(3277 * math.sin(2 * math.pi * 500 * (i // 2) / 48000)) for i in range(1920))).tobytes()
+
+
+class FakePCM:
+    """Stands in for ffmpeg's stdout."""
+    def __init__(self, seconds, delay=0):
+        self.left = int(seconds * 50)
+        self.delay = delay
+
+    def read(self, size):
+        if self.delay:
+            time.sleep(self.delay) # connecting to the stream
+            self.delay = 0
+        if self.left <= 0:
+            return b''
+        self.left -= 1
+        return TONE[:size]
+
+
+# writes `seconds` of the tone to stdout like the ffmpeg of a transcoded track
+TONE_DECODER = '''
+import array, math, sys, time
+tone = array.array('h', (int(3277 * math.sin(2 * math.pi * 500 * (i // 2) / 48000)) for i in range(1920))).tobytes()
+time.sleep(float(sys.argv[2]))
+for _ in range(int(float(sys.argv[1]) * 50)):
+    sys.stdout.buffer.write(tone)
+'''
+
+
+def fakeDecodeArgs(seconds, delay):
+    def decodeArgs(url, headers=None, before_options=''):
+        return [sys.executable, '-c', TONE_DECODER, str(seconds), str(delay)]
+    return decodeArgs
+
+
+class FakeOggSource:
+    """Stands in for OggOpusSource, yields 20ms stereo CELT packets."""
+    PACKET = bytes([0xFC]) + bytes(159)
+    seconds = 3
+    delay = 0
+
+    def __init__(self, url, headers=None, before_options=''):
+        self.left = int(self.seconds * 50)
+        self.pid = None
+
+    def open(self):
+        time.sleep(self.delay) # connecting to the stream
+        return self
+
+    def __iter__(self):
+        while self.left > 0:
+            self.left -= 1
+            yield self.PACKET
+
+    def close(self):
+        self.left = 0
+
+
+class FakeVoiceClient:
+    """Accepts frames from players instead of sending them over UDP."""
+    def __init__(self, channel, stats, track_seconds, connect_delay):
+        self.channel = channel
+        self.server = channel.server
+        self.stats = stats
+        self.track_seconds = track_seconds
+        self.connect_delay = connect_delay
+        self._connected = threading.Event()
+        self._connected.set()
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def play_audio(self, data, *, encode=True):
+        self.stats['frames'] += 1
+        self.stats['frame_bytes'] += len(data)
+
+    def create_ffmpeg_player(self, filename, *, after=None, **kwargs):
+        from opusplayer import FramePlayer
+        # frames are read through .buff like StreamPlayer does, so wrappers installed on it run
+        player = FramePlayer(iter(lambda: player.buff.read(len(TONE)), b''), self, after=after)
+        player.buff = FakePCM(self.track_seconds, self.connect_delay)
+        return player
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self):
+        self._connected.clear()
+
+
+class FakeGateway:
+    """Replaces the client's REST and voice calls with local stubs."""
+    def __init__(self, client, latency, track_seconds, connect_delay):
+        self.client = client
+        self.latency = latency
+        self.track_seconds = track_seconds
+        self.connect_delay = connect_delay
+        self.stats = collections.Counter()
+        self.voice_stats = collections.Counter()
+
+    def install(self, servers):
+        client = self.client
+        client.connection._servers = {server.id: server for server in servers}
+        client.connection.user = FakeMember('bot', 'Bot', None, [])
+        client.send_message = self.send_message
+        client.edit_message = self.edit_message
+        client.delete_message = self.noop
+        client.change_presence = self.noop
+        client.add_roles = self.noop
+        client.kick = self.noop
+        client.join_voice_channel = self.join_voice_channel
+
+    async def send_message(self, destination, content=None, *, tts=False, embed=None):
+        self.stats['sent'] += 1
+        await asyncio.sleep(self.latency)
+        return FakeMessage(content or '', self.client.user, destination)
+
+    async def edit_message(self, message, new_content=None, *, embed=None):
+        self.stats['edited'] += 1
+        await asyncio.sleep(self.latency)
+        message.content = new_content
+        return message
+
+    async def noop(self, *args, **kwargs):
+        self.stats['other'] += 1
+        await asyncio.sleep(self.latency)
+
+    async def join_voice_channel(self, channel):
+        self.stats['voice_joins'] += 1
+        await asyncio.sleep(self.latency * 10)
+        return FakeVoiceClient(channel, self.voice_stats, self.track_seconds, self.connect_delay)
+
+
+def fakeExtractor(delay, duration):
+    def extract(query):
+        time.sleep(delay)
+        key = str(abs(hash(query)))
+        return {
+            'id': key, 'extractor': 'bench', 'title': query, 'uploader': 'bench',
+            'duration': duration, 'url': 'bench://' + key, 'webpage_url': 'https://bench.invalid/' + key,
+            # every other track is Opus and passed through, the rest is transcoded
+            'http_headers': None, 'is_live': False, 'acodec': 'opus' if int(key) % 2 else 'aac', 'abr': 128, 'asr': 48000,
+            'resolved_at': time.time(), 'resolve_time': delay,
+        }
+    return extract
+
+#Event stream
+
+class Workload:
+    WEIGHTS = (
+        ('on_message', 70),
+        ('command', 5),
+        ('on_message_edit', 10),
+        ('on_message_delete', 10),
+        ('on_member_update', 4),
+        ('on_member_remove', 1),
+    )
+    COMMANDS = (
+        ('47!play song {}', 4),
+        ('47!playing', 3),
+        ('47!skip', 2),
+        ('47!queue', 2),
+        ('47!move 2 1', 1),
+        ('47!shuffle', 1),
+        ('47!auditstats', 1),
+    )
+
+    def __init__(self, bot, servers, songs):
+        self.bot = bot
+        self.servers = servers
+        self.songs = songs
+        self.kinds = [name for name, weight in self.WEIGHTS for _ in range(weight)]
+        self.commands = [fmt for fmt, weight in self.COMMANDS for _ in range(weight)]
+        self.recent = collections.deque(maxlen=1000)
+
+    def _pick(self):
+        server = random.choice(self.servers)
+        member = random.choice(server.members)
+        channel = random.choice(server.channels[:20])
+        return server, member, channel
+
+    def event(self):
+        """Returns (name, coroutine) of the next synthetic event."""
+        kind = random.choice(self.kinds)
+        bot = self.bot
+        server, member, channel = self._pick()
+
+        if kind == 'on_message':
+            message = FakeMessage('hello there ' * random.randint(1, 8), member, channel)
+            self.recent.append(message)
+            return kind, bot.on_message(message)
+
+        if kind == 'command':
+            content = random.choice(self.commands).format(random.randrange(self.songs))
+            return 'command:' + content.split()[0][3:], bot.on_message(FakeMessage(content, member, channel))
+
+        if kind in ('on_message_edit', 'on_message_delete') and self.recent:
+            before = random.choice(self.recent)
+            data = {'id': before.id, 'channel_id': before.channel.id, 'guild_id': before.server.id}
+            if kind == 'on_message_delete':
+                return kind, bot.on_socket_response({'t': 'MESSAGE_DELETE', 'd': data})
+            data['content'] = before.content + ' (edited)'
+            return kind, bot.on_socket_response({'t': 'MESSAGE_UPDATE', 'd': data})
+
+        if kind == 'on_member_update':
+            after = member.copy()
+            role = random.choice(server.roles[1:])
+            if role in after.roles:
+                after.roles.remove(role)
+            else:
+                after.roles.append(role)
+            before, member.roles = member.copy(), after.roles
+            return kind, bot.on_member_update(before, after)
+
+        if kind == 'on_member_remove':
+            return kind, bot.on_member_remove(member)
+
+        return 'on_message', bot.on_message(FakeMessage('hi', member, channel))
+
+#Measurement
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def timed(latencies, errors, name, coro):
+    start = time.perf_counter()
+    try:
+        await coro
+    except Exception as e:
+        errors[name + ': ' + type(e).__name__] += 1
+    latencies[name].append(time.perf_counter() - start)
+
+
+async def lagMonitor(loop, samples, interval=0.01):
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+def rssMB():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(bot, args):
+    loop = bot.client.loop
+    random.seed(args.seed)
+    servers = [FakeServer(str(i), args.members, args.roles) for i in range(args.servers)]
+    gateway = FakeGateway(bot.client, args.send_latency, args.track_seconds, args.connect_delay)
+    gateway.install(servers)
+
+    music = bot.musicBot
+    music.resolver._extract = fakeExtractor(args.resolve_delay, args.track_seconds)
+    music.cache.min_plays = float('inf')
+    FakeOggSource.seconds = args.track_seconds
+    FakeOggSource.delay = args.connect_delay
+    bot.OggOpusSource = FakeOggSource
+    bot.decodeArgs = fakeDecodeArgs(args.track_seconds, args.connect_delay)
+    if music.transcoders is not None:
+        music.transcoders.library = os.path.join(ROOT, 'libopus.so')
+
+    bot.OWNER_ID = 'bench'
+    await bot.on_ready()
+
+    workload = Workload(bot, servers, args.songs)
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    lag = []
+    monitor = loop.create_task(lagMonitor(loop, lag))
+    pending = set()
+
+    gc.collect()
+    rss_before = rssMB()
+    started = time.perf_counter()
+    sent = 0
+    tick = 0.005
+    while time.perf_counter() - started < args.duration:
+        due = int((time.perf_counter() - started) * args.rate) - sent
+        for _ in range(due):
+            name, coro = workload.event()
+            task = loop.create_task(timed(latencies, errors, name, coro))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            sent += 1
+        await asyncio.sleep(tick)
+
+    if pending:
+        await asyncio.wait(pending, timeout=30)
+    elapsed = time.perf_counter() - started
+    monitor.cancel()
+
+    states = len(music.voice_states)
+    gaps = [gap for state in music.voice_states.values() for gap in state.gaps]
+    queued = sum(state.songs.qsize() for state in music.voice_states.values())
+    for server_id in list(music.voice_states):
+        await music.teardown(server_id)
+    await asyncio.sleep(args.track_seconds / 4)
+
+    print('events: {} in {:.1f}s, {:.0f}/s (target {}/s)'.format(sent, elapsed, sent / elapsed, args.rate))
+    print()
+    print('{:<22} {:>8} {:>10} {:>10} {:>10}'.format('handler', 'count', 'p50 ms', 'p99 ms', 'max ms'))
+    for name in sorted(latencies):
+        values = latencies[name]
+        print('{:<22} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            name, len(values), percentile(values, 0.5) * 1e3, percentile(values, 0.99) * 1e3, max(values) * 1e3))
+    print()
+    print('loop lag: p50 {:.2f}ms  p99 {:.2f}ms  max {:.2f}ms'.format(
+        percentile(lag, 0.5) * 1e3, percentile(lag, 0.99) * 1e3, max(lag or [0]) * 1e3))
+    print('memory: max RSS {:.1f}MB ({:+.1f}MB during the run)'.format(rssMB(), rssMB() - rss_before))
+    print('gateway: {}'.format(dict(gateway.stats)))
+    print('voice: {} states, {} queued, {}'.format(states, queued, dict(gateway.voice_stats)))
+    print('audit: {}'.format(dict(bot.auditLog.stats)))
+    print('resolver: {}'.format(dict(music.resolver.stats)))
+    print('streams: {}'.format(dict(music.costs.streams)))
+    print('gaps between tracks: {} measured, p50 {:.0f}ms  p99 {:.0f}ms  max {:.0f}ms'.format(
+        len(gaps), percentile(gaps, 0.5) * 1e3, percentile(gaps, 0.99) * 1e3, max(gaps or [0]) * 1e3))
+    if music.transcoders is not None:
+        print('transcoders: {}'.format(dict(music.transcoders.stats)))
+        music.transcoders.close()
+    print('status messages: {}'.format(dict(bot.StatusMessage.totals)))
+    if errors:
+        print('errors: {}'.format(dict(errors)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rate', type=int, default=500, help='events per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to replay events for')
+    parser.add_argument('--servers', type=int, default=10)
+    parser.add_argument('--members', type=int, default=500, help='members per server')
+    parser.add_argument('--roles', type=int, default=50, help='roles per server')
+    parser.add_argument('--songs', type=int, default=200, help='distinct play queries')
+    parser.add_argument('--track-seconds', type=float, default=3, help='length of a fake track')
+    parser.add_argument('--send-latency', type=float, default=0.005, help='simulated REST latency')
+    parser.add_argument('--resolve-delay', type=float, default=0.05, help='simulated extraction time')
+    parser.add_argument('--connect-delay', type=float, default=0.3, help='simulated time until a stream\'s first audio')
+    parser.add_argument('--prefetch', type=int, help='PREFETCH_DEPTH for the run, the bot\'s default if not given')
+    parser.add_argument('--seed', type=int, default=47)
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve the bot metrics on this port while running')
+    args = parser.parse_args(argv)
+
+    # the bot writes its logs and caches relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix='loadtest-'))
+    # there is no voice connection to encode for
+    discord.opus.is_loaded = lambda: True
+    if args.prefetch is not None:
+        os.environ['PREFETCH_DEPTH'] = str(args.prefetch)
+
+    import DiscordBot
+    loop = DiscordBot.client.loop
+    if args.metrics_port:
+        loop.run_until_complete(DiscordBot.metrics.serve('127.0.0.1', args.metrics_port))
+        loop.create_task(DiscordBot.metrics.monitor_lag())
+    loop.run_until_complete(run(DiscordBot, args))
+    DiscordBot.auditLog.close()
+    DiscordBot.musicBot.journal.close()
+    DiscordBot.messageLog.close()
+    DiscordBot.chatLog.close()
+    DiscordBot.eventLog.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Insert rate and search latency of the SQLite message log.
+
+Fills a fresh database through MessageLog.add() with a synthetic chat,
+then times the searches the search command runs.
+
+    python3 bench/messagelog.py --messages 1000000
+    python3 bench/messagelog.py --messages 20000000 --path /tmp/big.db
+"""
+import argparse, datetime, os, random, statistics, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from messagelog import MessageLog, snowflake
+
+WORDS = ('the a to and of you i it is that lol what in this for no yes on with just bot play skip song '
+         'game tonight server voice music when who why how ok nice gg rip meme link stream').split()
+RARE = ['word{}'.format(i) for i in range(5000)]
+
+
+class Obj:
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class Message:
+    def __init__(self, id, server, channel, author, content):
+        self.id = id
+        self.server = server
+        self.channel = channel
+        self.author = author
+        self.content = content
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--servers', type=int, default=20)
+    parser.add_argument('--days', type=int, default=365, help='the messages are spread over this many days')
+    parser.add_argument('--path', help='database file, a temporary one by default')
+    args = parser.parse_args()
+
+    path = args.path or os.path.join(tempfile.mkdtemp(prefix='messagelog-'), 'messages.db')
+    rng = random.Random(47)
+    servers = [Obj(str(10 ** 17 + i)) for i in range(args.servers)]
+    channels = [[Obj(str(2 * 10 ** 17 + i * 100 + c)) for c in range(20)] for i in range(args.servers)]
+    users = [Obj(str(3 * 10 ** 17 + u), 'user{}#0001'.format(u)) for u in range(5000)]
+
+    log = MessageLog(path, batch=5000, max_queue=200000)
+    start = snowflake(datetime.datetime.utcnow() - datetime.timedelta(days=args.days))
+    step = (snowflake(datetime.datetime.utcnow()) - start) // args.messages
+    started = time.perf_counter()
+    for n in range(args.messages):
+        s = rng.randrange(args.servers)
+        words = [rng.choice(WORDS) for _ in range(rng.randint(1, 12))]
+        if rng.random() < 0.2:
+            words.append(rng.choice(RARE))
+        message = Message(str(start + n * step), servers[s], rng.choice(channels[s]), rng.choice(users), ' '.join(words))
+        while True:
+            before = log.dropped
+            log.add(message)
+            if log.dropped == before:
+                break
+            log.dropped -= 1
+            time.sleep(0.01)
+    log.close(timeout=None)
+    elapsed = time.perf_counter() - started
+    print('inserted {} messages in {:.1f}s, {:.0f}/s, fts{} database {:.0f}MB'.format(
+        log.written, elapsed, log.written / elapsed, log.fts, os.path.getsize(path) / 1024 / 1024))
+
+    log = MessageLog(path)
+    now = datetime.datetime.utcnow()
+    server = servers[0].id
+    queries = [
+        ('user', dict(author=users[7].id)),
+        ('channel, last 7 days', dict(channel=channels[0][3].id, after=now - datetime.timedelta(days=7))),
+        ('common word', dict(text='music')),
+        ('rare word', dict(text='word4242')),
+        ('two words', dict(text='nice stream')),
+        ('user + word', dict(author=users[7].id, text='game')),
+        ('user + rare word', dict(author=users[7].id, text='word17')),
+        ('channel + 30 days + word', dict(channel=channels[0][3].id, after=now - datetime.timedelta(days=30), text='voice')),
+        ('word, a year ago', dict(text='gg', before=now - datetime.timedelta(days=args.days - 30))),
+        ('no match', dict(text='zzzz')),
+    ]
+    print()
+    print('{:<28} {:>8} {:>10} {:>10}'.format('search', 'results', 'median ms', 'max ms'))
+    for name, kwargs in queries:
+        times = []
+        for _ in range(5):
+            t = time.perf_counter()
+            rows = log.search(server, limit=10, **kwargs)
+            times.append(time.perf_counter() - t)
+        print('{:<28} {:>8} {:>10.1f} {:>10.1f}'.format(name, len(rows), statistics.median(times) * 1e3, max(times) * 1e3))
+    log.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Memory per message of the audit message store against the library's cache.
+
+Fills a MessageStore and a deque of discord.Message objects, like the
+client keeps, with the same synthetic chat and measures both with
+tracemalloc. Authors are shared Member-like objects in both, as they are
+in a server the client has chunked.
+
+    python3 bench/messages.py
+    python3 bench/messages.py --messages 50000 --budget 8
+"""
+import argparse, collections, os, random, sys, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from messagestore import MessageStore
+
+WORDS = 'the a to and of you i it is that lol what in this for no yes on with just bot play skip song'.split()
+
+
+class Author:
+    def __init__(self, id):
+        self.id = id
+
+
+class Server:
+    def __init__(self, id, members):
+        self.id = id
+        self.members = {member.id: member for member in members}
+
+    def get_member(self, id):
+        return self.members.get(id)
+
+
+class Channel:
+    def __init__(self, id, server):
+        self.id = id
+        self.server = server
+        self.is_private = False
+
+
+class Message:
+    """The attributes MessageStore.add reads."""
+    def __init__(self, id, author, channel, content):
+        self.id = id
+        self.author = author
+        self.channel = channel
+        self.content = content
+
+
+def chat(count, servers, seed=47):
+    """Yields (server, author, channel, message id, content) of a synthetic chat."""
+    rng = random.Random(seed)
+    snowflake = 400000000000000000
+    for _ in range(count):
+        server, channels = rng.choice(servers)
+        author = rng.choice(list(server.members.values()))
+        snowflake += rng.randrange(1, 1 << 22)
+        content = ' '.join(rng.choice(WORDS) for _ in range(int(rng.expovariate(1 / 9)) + 1))
+        yield server, author, rng.choice(channels), str(snowflake), content
+
+
+def measure(fill):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = fill()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return kept, used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--servers', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=64, help='store budget in MB')
+    args = parser.parse_args()
+
+    servers = []
+    for i in range(args.servers):
+        server = Server(str(i), [Author(str(10 ** 17 + i * 1000 + m)) for m in range(200)])
+        servers.append((server, [Channel(str(10 ** 17 + i * 1000 + 900 + c), server) for c in range(10)]))
+    events = list(chat(args.messages, servers))
+
+    def fillStore():
+        store = MessageStore(int(args.budget * 1024 * 1024))
+        for server, author, channel, id, content in events:
+            store.add(server.id, Message(id, author, channel, content))
+        fillStore.store = store
+        return len(store)
+
+    rows = [('message store', measure(fillStore))]
+    print('store estimate: {:.1f}MB for {} messages, {} evicted'.format(
+        fillStore.store.size / 1024 / 1024, len(fillStore.store), fillStore.store.evicted))
+
+    try:
+        import discord
+    except ImportError:
+        print('discord.py is not installed, skipping the library cache')
+    else:
+        def fillCache():
+            cache = collections.deque(maxlen=args.messages)
+            for server, author, channel, id, content in events:
+                data = {
+                    'id': id, 'content': content, 'channel_id': channel.id, 'type': 0, 'tts': False, 'pinned': False,
+                    'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [],
+                    'timestamp': '2018-01-01T12:00:00.000000+00:00', 'edited_timestamp': None,
+                    'author': {'id': author.id, 'username': 'user', 'discriminator': '0001', 'avatar': None},
+                }
+                cache.append(discord.Message(channel=channel, reactions=[], **data))
+            fillCache.cache = cache
+            return len(cache)
+        rows.append(('discord.Message deque', measure(fillCache)))
+
+    print()
+    print('{:<22} {:>9} {:>9} {:>10} {:>11}'.format('', 'messages', 'MB', 'bytes/msg', 'msgs per MB'))
+    for name, (kept, used) in rows:
+        print('{:<22} {:>9} {:>9.1f} {:>10.0f} {:>11.0f}'.format(name, kept, used / 1024 / 1024, used / kept, kept / (used / 1024 / 1024)))
+
+
+if __name__ == '__main__':
+    main()
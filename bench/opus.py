@@ -0,0 +1,105 @@
+"""CPU per 20ms frame the bot spends on a stream, transcoded and passed through.
+
+  transcode     PCMStage at volume 0.6 plus the libopus encode play_audio does
+  pooled        the same in a transcoder worker, the bot only takes the packets
+  passthrough   splitting ffmpeg's Ogg output into packets
+
+Only the bot process is measured, for pooled the worker's encoding thread
+is added, like the streams command counts it, and the bot's share is
+shown on its own. ffmpeg is not run: on the transcode paths it also decodes
+and resamples the source, on the passthrough path it only copies packets,
+so the real difference is larger than shown here. A script writing the
+tone stands in for the pooled path's ffmpeg. Streams per core is 20ms
+divided by the cost of a frame.
+
+    python3 bench/opus.py [seconds of audio]
+"""
+import array, io, math, os, struct, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import discord.opus
+import opusplayer, pcm, transcoder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRAME_BYTES = 3840
+# a 440Hz tone at -10 dBFS, stereo
+FRAME = array.array('h', (int(10362 * math.sin(2 * math.pi * 440 * (i // 2) / 48000)) for i in range(FRAME_BYTES // 2))).tobytes()
+DECODER = '''
+import array, math, sys
+frame = array.array('h', (int(10362 * math.sin(2 * math.pi * 440 * (i // 2) / 48000)) for i in range(1920))).tobytes()
+for _ in range(int(sys.argv[1])):
+    sys.stdout.buffer.write(frame)
+'''
+
+
+class Source:
+    def __init__(self, frames):
+        self.left = frames
+
+    def read(self, size):
+        if self.left <= 0:
+            return b''
+        self.left -= 1
+        return FRAME[:size]
+
+
+def oggPage(packets, sequence, granule, flags=0):
+    lacing = bytearray()
+    for packet in packets:
+        lacing += b'\xff' * (len(packet) // 255) + bytes([len(packet) % 255])
+    # the checksum is left at 0, the demuxer does not verify it
+    header = opusplayer.OGG_PAGE.pack(b'OggS', 0, flags, granule, 1, sequence, 0, len(lacing))
+    return header + bytes(lacing) + b''.join(packets)
+
+
+def oggStream(packets, per_page=50):
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 2, 312, 48000, 0, 0)
+    tags = b'OpusTags' + struct.pack('<I', 5) + b'bench' + struct.pack('<I', 0)
+    pages = [oggPage([head], 0, 0, flags=2), oggPage([tags], 1, 0)]
+    for i in range(0, len(packets), per_page):
+        pages.append(oggPage(packets[i:i + per_page], len(pages), (i + per_page) * 960))
+    return b''.join(pages)
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    frames = seconds * 50
+    if not discord.opus.is_loaded():
+        discord.opus.load_opus(os.path.join(ROOT, 'libopus.so'))
+    encoder = discord.opus.Encoder(48000, 2)
+
+    stage = pcm.PCMStage(Source(frames), 0.6)
+    packets = []
+    started = time.process_time()
+    while True:
+        data = stage.read(FRAME_BYTES)
+        if len(data) < FRAME_BYTES:
+            break
+        packets.append(encoder.encode(data, 960))
+    transcode = (time.process_time() - started) / frames
+
+    pool = transcoder.TranscoderPool(1, os.path.join(ROOT, 'libopus.so'))
+    pooled = transcoder.TranscodedStream(pool, [sys.executable, '-c', DECODER, str(frames)], 0.6).open()
+    started = time.process_time()
+    received = sum(1 for packet in pooled)
+    pooled_bot = (time.process_time() - started) / received
+    pooled_worker = pooled.cpu / received
+    pool.close()
+    assert received == frames, 'pooled stream ended early'
+
+    stream = oggStream(packets)
+    source = io.BytesIO(stream)
+    started = time.process_time()
+    demuxed = list(opusplayer.oggPackets(source))
+    passthrough = (time.process_time() - started) / frames
+    assert demuxed[2:] == packets, 'demuxed packets differ'
+    assert all(opusplayer.packetTenths(packet) == 200 for packet in packets)
+
+    print('{} seconds of audio, {} packets of {:.0f} bytes on average'.format(seconds, frames, sum(map(len, packets)) / frames))
+    for name, cost in (('transcode', transcode), ('pooled', pooled_bot + pooled_worker), ('passthrough', passthrough)):
+        print('  {:<12} {:8.1f} us/frame {:8.0f} streams per core'.format(name, cost * 1e6, 0.02 / cost))
+    print('  of pooled, in the bot process {:.1f} us/frame'.format(pooled_bot * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Cost per 20ms frame of the PCM stage and how much it clips.
+
+Compares, on a loud tone:
+
+  python loop   scaling every sample in Python
+  library       what StreamPlayer does with player.volume (audioop.mul, volume capped at 2.0)
+  stage         PCMStage while measuring loudness, then with a known gain
+
+Streams per core is 20ms divided by the cost of a frame.
+
+    python3 bench/pcm.py
+"""
+import array, audioop, math, os, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pcm
+
+FRAME_BYTES = 3840
+# a 440Hz tone peaking at -3 dBFS, stereo
+FRAME = array.array('h', (int(23197 * math.sin(2 * math.pi * 440 * (i // 2) / 48000)) for i in range(FRAME_BYTES // 2))).tobytes()
+
+
+class Source:
+    def read(self, size):
+        return FRAME[:size]
+
+
+def pythonLoop(data, volume=0.6):
+    samples = array.array('h', data)
+    for i in range(len(samples)):
+        samples[i] = max(-32768, min(32767, int(samples[i] * volume)))
+    return samples.tobytes()
+
+
+def clipped(data):
+    samples = array.array('h', data)
+    return sum(1 for s in samples if s >= 32767 or s <= -32768)
+
+
+def main():
+    rows = []
+
+    def add(name, fn, number):
+        cost = min(timeit.repeat(fn, number=number, repeat=5)) / number
+        rows.append((name, cost))
+
+    add('python loop', lambda: pythonLoop(FRAME), 20)
+    add('library, volume 0.6', lambda: audioop.mul(FRAME, 2, 0.6), 20000)
+    measuring = pcm.PCMStage(Source(), 0.6, None, lambda gain: None)
+    def measure():
+        measuring.measured = lambda gain: None
+        measuring._frames = 0
+        measuring.read(FRAME_BYTES)
+    add('stage, measuring', measure, 20000)
+    known = pcm.PCMStage(Source(), 0.6, 0.8)
+    add('stage, volume 0.6', lambda: known.read(FRAME_BYTES), 20000)
+    loud = pcm.PCMStage(Source(), 2.0, 1.5)
+    add('stage, volume 2.0', lambda: loud.read(FRAME_BYTES), 20000)
+
+    print('{:<28} {:>10} {:>16}'.format('', 'us/frame', 'streams/core'))
+    for name, cost in rows:
+        print('{:<28} {:>10.2f} {:>16.0f}'.format(name, cost * 1e6, 0.02 / cost))
+
+    print()
+    print('clipped samples per frame at the highest volume:')
+    print('  library, volume 10000000 (capped at 2.0): {}'.format(clipped(audioop.mul(FRAME, 2, min(10000000, 2.0)))))
+    stage = pcm.PCMStage(Source(), 10000000, pcm.MAX_GAIN)
+    print('  stage, volume 10000000 (capped at {}), gain {}: {}'.format(pcm.MAX_VOLUME, pcm.MAX_GAIN, max(clipped(stage.read(FRAME_BYTES)) for _ in range(100))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Micro-benchmark of the on_member_update role diff.
+
+Compares roleDiff with the nested loop it replaced for members holding
+1, 50 and 250 roles, with one role given and one removed.
+
+    python3 bench/roles.py
+"""
+import os, sys, timeit
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from audit import roleDiff
+
+Role = namedtuple('Role', 'id name position is_everyone')
+
+
+def nestedLoop(before, after):
+    """The old pairwise comparison, returns how many embeds it would send."""
+    broles = before[1:]
+    aroles = after[1:]
+    sends = 0
+    for roleb in broles:
+        for rolea in aroles:
+            if rolea not in broles:
+                sends += 1
+            if roleb not in aroles:
+                sends += 1
+    return sends
+
+
+def makeRoles(n):
+    everyone = Role('0', '@everyone', 0, True)
+    roles = [Role(str(i), 'role' + str(i), i, False) for i in range(1, n + 2)]
+    before = [everyone] + roles[:n]
+    after = [everyone] + roles[1:n + 1]
+    return before, after
+
+
+def main():
+    print('{:>6} {:>14} {:>14} {:>12}'.format('roles', 'roleDiff (us)', 'nested (us)', 'old sends'))
+    for n in (1, 50, 250):
+        before, after = makeRoles(n)
+        number = max(10, 20000 // n)
+        new = min(timeit.repeat(lambda: roleDiff(before, after), number=number, repeat=5)) / number
+        # the old loop is cubic in the role count, keep its run short
+        number = max(1, 20000 // n ** 3)
+        old = min(timeit.repeat(lambda: nestedLoop(before, after), number=number, repeat=3)) / number
+        print('{:>6} {:>14.2f} {:>14.2f} {:>12}'.format(n, new * 1e6, old * 1e6, nestedLoop(before, after)))
+
+
+if __name__ == '__main__':
+    main()
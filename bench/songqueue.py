@@ -0,0 +1,62 @@
+"""Cost of the queue commands on a long queue, SongQueue against asyncio.Queue.
+
+asyncio.Queue cannot be listed or edited without reaching into its private
+deque, removing the 5000th entry means draining and refilling it.
+
+    python3 bench/songqueue.py [entries]
+"""
+import asyncio, collections, os, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from songqueue import SongQueue
+
+Entry = collections.namedtuple('Entry', 'id user')
+
+
+def refill(queue, keep):
+    entries = []
+    while not queue.empty():
+        entries.append(queue.get_nowait())
+    for entry in entries:
+        if keep(entry):
+            queue.put_nowait(entry)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    loop = asyncio.get_event_loop()
+    entries = [Entry(i, i % 20) for i in range(size)]
+    songs = SongQueue(lambda entry: entry.user, loop=loop)
+    plain = asyncio.Queue()
+    for entry in entries:
+        songs.put_nowait(entry)
+        plain.put_nowait(entry)
+
+    def removeAt():
+        songs.put_nowait(songs.remove(size // 2))
+
+    def removeUser():
+        for entry in songs.remove_by(3):
+            songs.put_nowait(entry)
+
+    def plainRemove():
+        refill(plain, lambda entry: entry.id != size // 2)
+        plain.put_nowait(entries[size // 2])
+
+    cases = (
+        ('page 50', lambda: songs.page(50)),
+        ('remove middle', removeAt),
+        ('remove by user', removeUser),
+        ('move last to first', lambda: songs.move(size - 1, 0)),
+        ('shuffle', songs.shuffle),
+        ('asyncio.Queue remove middle', plainRemove),
+    )
+    print('{} entries'.format(size))
+    for name, case in cases:
+        number = 200
+        best = min(timeit.repeat(case, number=number, repeat=3)) / number
+        print('  {:<30} {:9.1f} us'.format(name, best * 1e6))
+
+
+if __name__ == '__main__':
+    main()
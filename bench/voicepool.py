@@ -0,0 +1,94 @@
+"""Rejoining every server at once, directly and through the VoiceConnector.
+
+The voice region is simulated: it works on `--capacity` handshakes at a
+time, each one takes `--latency` seconds, and the rest wait in line. The
+client gives up after 10s like join_voice_channel does, but the region
+still works through the handshakes it abandoned. A burst of joins then
+fails for everyone past the first 10s worth, and retrying them at once
+only makes the line longer.
+
+    python3 bench/voicepool.py --servers 300
+"""
+import argparse, asyncio, os, random, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from voicepool import VoiceConnector
+
+
+class Obj:
+    def __init__(self, id, server=None):
+        self.id = id
+        self.server = server
+
+
+class Region:
+    """Stands in for the bot's join_voice_channel and voice client list."""
+    def __init__(self, latency, capacity, timeout=10.0):
+        self.latency = latency
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(capacity)
+        self.voice_clients = []
+
+    async def handshake(self):
+        async with self.slots:
+            await asyncio.sleep(self.latency * random.uniform(0.8, 1.2))
+
+    async def join_voice_channel(self, channel):
+        # shielded, the region does not notice the client giving up
+        await asyncio.wait_for(asyncio.shield(self.handshake()), self.timeout)
+        return Obj(channel.id, channel.server)
+
+    def voice_client_in(self, server):
+        return None
+
+    def is_voice_connected(self, server):
+        return False
+
+
+async def direct(region, channel):
+    started = time.perf_counter()
+    await region.join_voice_channel(channel)
+    return time.perf_counter() - started
+
+
+async def pooled(connector, channel):
+    started = time.perf_counter()
+    await connector.connect(channel)
+    return time.perf_counter() - started
+
+
+async def run(name, coros):
+    started = time.perf_counter()
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    times = sorted(r for r in results if isinstance(r, float))
+    failed = len(results) - len(times)
+    pick = lambda q: times[min(len(times) - 1, int(q * len(times)))] if times else 0.0
+    print('{:<10} joined {:>4}/{:<4} failed {:>4}  until joined p50 {:6.2f}s p99 {:6.2f}s  all done in {:6.2f}s'.format(
+        name, len(times), len(results), failed, pick(0.5), pick(0.99), elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--servers', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=1.0, help='seconds a handshake takes')
+    parser.add_argument('--capacity', type=int, default=10, help='handshakes the region works on at once')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(1)
+    loop = asyncio.get_event_loop()
+    channels = [Obj(i, Obj(i)) for i in range(args.servers)]
+
+    region = Region(args.latency, args.capacity)
+    loop.run_until_complete(run('direct', [direct(region, channel) for channel in channels]))
+
+    region = Region(args.latency, args.capacity)
+    connector = VoiceConnector(region, args.concurrency, args.rate)
+    loop.run_until_complete(run('connector', [pooled(connector, channel) for channel in channels]))
+    print('connector stats:', dict(connector.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import asyncio, heapq, sys, time, traceback
+
+
+class IdleScheduler:
+    """Single timer heap that fires `expire(key)` once a key stays idle.
+
+    arm() (re)starts a key's timer, cancel() stops it. Superseded heap
+    entries are skipped lazily when they reach the top. When a timer fires
+    `is_idle(key)` is asked first, keys that turned busy again are re-armed
+    instead of expired. The number of tasks does not depend on the number
+    of keys.
+    """
+    def __init__(self, loop, timeout, is_idle, expire):
+        self.loop = loop
+        self.timeout = timeout
+        self.is_idle = is_idle
+        self.expire = expire
+        self._deadlines = {}
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def arm(self, key, timeout=None):
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(d, k) for k, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        if self._heap[0][0] == deadline:
+            self._wakeup.set()
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            deadline, key = self._heap[0]
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            del self._deadlines[key]
+            try:
+                if self.is_idle(key):
+                    await self.expire(key)
+                else:
+                    self.arm(key)
+            except Exception:
+                # the loop keeps running for the other keys
+                print('Ignoring exception expiring {}'.format(key), file=sys.stderr)
+                traceback.print_exc()
@@ -0,0 +1,155 @@
+import collections, json, os, queue, threading
+
+# info keys worth keeping across restarts, stream URLs expire long before that
+KEEP_INFO = ('id', 'extractor', 'title', 'uploader', 'duration', 'webpage_url', 'is_live', 'acodec', 'abr', 'asr')
+
+
+class QueueJournal:
+    """Append-only journal of every server's music queue.
+
+    Each change is one JSON line:
+
+        voice   the voice channel the bot is in, or None once it left
+        add     an entry was queued
+        current an entry started playing
+        pos     playback offset of the current entry in seconds
+        done    an entry finished, was skipped or removed
+        order   queued entries were moved, lists their new order
+        clear   the server's queue and voice connection were torn down
+
+    The state the lines describe is kept in memory as well. Lines are
+    written by a background thread and the file is rewritten as a snapshot
+    of that state every `compact_every` lines, so it stays small.
+    """
+    _STOP = object()
+
+    def __init__(self, path, compact_every=2000):
+        self.path = path
+        self.compact_every = compact_every
+        self.servers = {}
+        self.appended = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def _server(self, server_id):
+        server = self.servers.get(server_id)
+        if server is None:
+            server = self.servers[server_id] = {'voice': None, 'entries': collections.OrderedDict(), 'current': None, 'pos': 0}
+        return server
+
+    def _apply(self, record):
+        op = record['op']
+        sid = record['s']
+        if op == 'clear':
+            self.servers.pop(sid, None)
+            return
+        server = self._server(sid)
+        if op == 'voice':
+            server['voice'] = record['c']
+        elif op == 'add':
+            server['entries'][record['e']] = record['d']
+        elif op == 'current':
+            server['current'] = record['e']
+            server['pos'] = 0
+        elif op == 'pos':
+            server['pos'] = record['t']
+        elif op == 'order':
+            entries = server['entries']
+            for eid in record['e']:
+                if eid in entries:
+                    entries.move_to_end(eid)
+        elif op == 'done':
+            server['entries'].pop(record['e'], None)
+            if server['current'] == record['e']:
+                server['current'] = None
+                server['pos'] = 0
+
+    def load(self):
+        """Reads the journal into memory, a torn last line is ignored."""
+        self.servers = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        continue
+        return self.servers
+
+    def start(self):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='QueueJournal', daemon=True)
+        self._thread.start()
+        self.compact()
+
+    def close(self, timeout=5.0):
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def record(self, op, server_id, **fields):
+        fields['op'] = op
+        fields['s'] = server_id
+        self._apply(fields)
+        if self._thread is None:
+            return
+        self._queue.put(json.dumps(fields, separators=(',', ':')))
+        self.appended += 1
+        if self.appended >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Queues a rewrite of the file as a snapshot of the current state."""
+        lines = []
+        for sid, server in self.servers.items():
+            if server['voice'] is not None:
+                lines.append({'op': 'voice', 's': sid, 'c': server['voice']})
+            for eid, data in server['entries'].items():
+                lines.append({'op': 'add', 's': sid, 'e': eid, 'd': data})
+            if server['current'] is not None:
+                lines.append({'op': 'current', 's': sid, 'e': server['current']})
+                lines.append({'op': 'pos', 's': sid, 't': server['pos']})
+        self._queue.put([json.dumps(line, separators=(',', ':')) for line in lines])
+        self.appended = 0
+
+    def _run(self):
+        out = open(self.path, 'a', encoding='utf-8')
+        try:
+            while True:
+                item = self._queue.get()
+                batch = [item]
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                for item in batch:
+                    if item is self._STOP:
+                        return
+                    if isinstance(item, list):
+                        out.close()
+                        tmp = self.path + '.tmp'
+                        with open(tmp, 'w', encoding='utf-8') as snapshot:
+                            snapshot.write(''.join(line + '\n' for line in item))
+                        os.replace(tmp, self.path)
+                        out = open(self.path, 'a', encoding='utf-8')
+                    else:
+                        out.write(item + '\n')
+                out.flush()
+        finally:
+            out.close()
+
+
+def entryRecord(entry):
+    """What the journal keeps of a VoiceEntry."""
+    return {
+        'r': entry.requester.id,
+        'c': entry.channel.id,
+        'q': entry.query,
+        'v': entry.volume,
+        'i': {key: entry.info.get(key) for key in KEEP_INFO},
+    }
@@ -0,0 +1,109 @@
+import os, queue, threading
+
+
+class LogSink:
+    """Buffered append-only log file written from a background thread.
+
+    write() never touches the disk, it only queues the line. A writer thread
+    drains the queue in batches, rotates the file once it grows past
+    max_bytes and flushes whatever is left on close().
+
+    When the queue is full the policy decides what happens:
+    'drop' discards the new line, 'oldest' discards the oldest queued line.
+    Both are counted in self.dropped.
+    """
+    _STOP = object()
+
+    def __init__(self, path, max_bytes=5 * 1024 * 1024, backups=3, max_queue=10000,
+                 batch=500, interval=1.0, policy='drop'):
+        if policy not in ('drop', 'oldest'):
+            raise ValueError('Unknown overflow policy: ' + str(policy))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch = batch
+        self.interval = interval
+        self.policy = policy
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._closed = False
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self._thread = threading.Thread(target=self._run, name='LogSink:' + path, daemon=True)
+        self._thread.start()
+
+    def write(self, line):
+        if self._closed:
+            return
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            if self.policy == 'oldest':
+                try:
+                    self._queue.get_nowait()
+                    self._queue.put_nowait(line)
+                except (queue.Empty, queue.Full):
+                    pass
+            self.dropped += 1
+
+    def close(self, timeout=5.0):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def _rotate(self, log):
+        log.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = '{}.{}'.format(self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        return open(self.path, 'a', encoding='utf-8')
+
+    def _run(self):
+        log = open(self.path, 'a', encoding='utf-8')
+        try:
+            stopping = False
+            while not stopping:
+                try:
+                    first = self._queue.get(timeout=self.interval)
+                except queue.Empty:
+                    continue
+
+                lines = []
+                item = first
+                while True:
+                    if item is self._STOP:
+                        stopping = True
+                    else:
+                        lines.append(item)
+                    if len(lines) >= self.batch:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                if not lines:
+                    continue
+                log.write('\n'.join(lines))
+                log.write('\n')
+                log.flush()
+                self.written += len(lines)
+
+                if self.max_bytes and log.tell() >= self.max_bytes:
+                    log = self._rotate(log)
+        finally:
+            log.close()
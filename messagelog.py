@@ -0,0 +1,249 @@
+import datetime, json, os, queue, sqlite3, threading, time
+from messagestore import DISCORD_EPOCH
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY, -- snowflake, so also the creation time
+    server INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    author INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_author ON messages (server, author, id);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel, id);
+-- per user retention applies across servers
+CREATE INDEX IF NOT EXISTS messages_user ON messages (author, id);
+-- the full text index also holds the server, channel and author as tags, so
+-- a search for a word by one user intersects two posting lists
+CREATE VIEW IF NOT EXISTS messages_source AS
+    SELECT id, content, 's' || server || ' c' || channel || ' u' || author AS tags FROM messages;
+'''
+
+FTS5 = "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, tags, content='messages_source', content_rowid='id')"
+# FTS4 cannot index a view, it keeps its own copy of the text
+FTS4 = "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts4(content, tags)"
+
+
+def snowflake(when):
+    """Smallest message id created at or after a UTC datetime."""
+    ms = int(when.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+    return max(ms - DISCORD_EPOCH, 0) << 22
+
+
+def snowflakeTime(id):
+    return datetime.datetime.utcfromtimestamp(((id >> 22) + DISCORD_EPOCH) / 1000)
+
+
+def ftsQuery(text, tags=()):
+    """Every word and tag has to appear, FTS syntax in the text is taken literally."""
+    terms = ['tags:' + tag for tag in tags]
+    terms += ['content:"' + word.replace('"', '""') + '"' for word in text.split()]
+    return ' '.join(terms)
+
+
+def tags(server, channel, author):
+    return 's{} c{} u{}'.format(server, channel, author)
+
+
+class Retention:
+    """How long messages are kept, in days: for everything, per channel and per user.
+
+    The shortest applicable period wins, None keeps messages forever and 0
+    does not store them at all. Read from a JSON file such as
+
+        {"days": 365, "channels": {"123": 30}, "users": {"456": 0}}
+    """
+    def __init__(self, days=None, channels=None, users=None):
+        self.days = days
+        self.channels = {int(k): v for k, v in (channels or {}).items()}
+        self.users = {int(k): v for k, v in (users or {}).items()}
+
+    @classmethod
+    def load(cls, path, days=None):
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        return cls(data.get('days', days), data.get('channels'), data.get('users'))
+
+    def keeps(self, channel, author):
+        return self.days != 0 and self.channels.get(channel) != 0 and self.users.get(author) != 0
+
+    def rules(self):
+        """(where clause, parameters, days) of every policy."""
+        if self.days is not None:
+            yield '1', (), self.days
+        for channel, days in self.channels.items():
+            yield 'channel = ?', (channel,), days
+        for author, days in self.users.items():
+            yield 'author = ?', (author,), days
+
+
+class MessageLog:
+    """SQLite message log with a full text index, written from a background thread.
+
+    add() only queues the row, the writer thread inserts rows in batches of
+    up to `batch` per transaction and applies the retention policies every
+    `prune_every` seconds. Searches use their own connection, the database
+    runs in WAL mode so they do not wait for the writer.
+    FTS5 is used when SQLite has it, FTS4 otherwise.
+    """
+    _STOP = object()
+
+    def __init__(self, path, retention=None, batch=2000, interval=1.0, max_queue=50000, prune_every=3600):
+        self.path = path
+        self.retention = retention or Retention()
+        self.batch = batch
+        self.interval = interval
+        self.prune_every = prune_every
+        self.written = 0
+        self.dropped = 0
+        self.pruned = 0
+        self._queue = queue.Queue(max_queue)
+        self._read_lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        db = self._connect()
+        db.executescript(SCHEMA)
+        self.fts = self._create_fts(db)
+        db.close()
+        self._reader = self._connect(check_same_thread=False)
+
+        self._thread = threading.Thread(target=self._run, name='MessageLog', daemon=True)
+        self._thread.start()
+
+    def _connect(self, **kwargs):
+        db = sqlite3.connect(self.path, **kwargs)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def _create_fts(self, db):
+        for version, sql in ((5, FTS5), (4, FTS4)):
+            try:
+                db.execute(sql)
+                return version
+            except sqlite3.OperationalError:
+                continue
+        return None
+
+    def add(self, message):
+        server, channel, author = int(message.server.id), int(message.channel.id), int(message.author.id)
+        if not self.retention.keeps(channel, author):
+            return
+        try:
+            self._queue.put_nowait((int(message.id), server, channel, author, str(message.author), message.content))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=10.0):
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        self._reader.close()
+
+    def _run(self):
+        db = self._connect()
+        pruned = time.monotonic()
+        stop = False
+        while not stop:
+            rows = []
+            try:
+                rows.append(self._queue.get(timeout=self.interval))
+                while len(rows) < self.batch:
+                    rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if rows and rows[-1] is self._STOP:
+                rows.pop()
+                stop = True
+            if rows:
+                self._insert(db, rows)
+            if time.monotonic() - pruned > self.prune_every:
+                pruned = time.monotonic()
+                self._prune(db)
+        db.close()
+
+    def _insert(self, db, rows):
+        with db:
+            db.executemany('INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)', rows)
+            if self.fts is not None:
+                db.executemany('INSERT INTO messages_fts (rowid, content, tags) VALUES (?, ?, ?)',
+                               ((row[0], row[5], tags(*row[1:4])) for row in rows))
+        self.written += len(rows)
+
+    def _prune(self, db, chunk=5000):
+        now = datetime.datetime.utcnow()
+        for where, params, days in self.retention.rules():
+            if days is None:
+                continue
+            cutoff = snowflake(now - datetime.timedelta(days=days))
+            while True:
+                ids = [row[0] for row in db.execute(
+                    'SELECT id FROM messages WHERE ' + where + ' AND id < ? LIMIT ?', params + (cutoff, chunk))]
+                if not ids:
+                    break
+                marks = ','.join('?' * len(ids))
+                with db:
+                    if self.fts == 5:
+                        db.execute("INSERT INTO messages_fts (messages_fts, rowid, content, tags) SELECT 'delete', id, content, tags FROM messages_source WHERE id IN (" + marks + ")", ids)
+                    elif self.fts == 4:
+                        db.execute('DELETE FROM messages_fts WHERE docid IN (' + marks + ')', ids)
+                    db.execute('DELETE FROM messages WHERE id IN (' + marks + ')', ids)
+                self.pruned += len(ids)
+
+    def search(self, server, author=None, channel=None, after=None, before=None, text=None, limit=10):
+        """Newest matching messages as (id, channel, author, name, content) rows, runs in a worker thread.
+
+        after and before are UTC datetimes.
+        """
+        if text and self.fts is not None:
+            # everything is matched by the index, time bounds on its rowid
+            rowid = 'f.rowid' if self.fts == 5 else 'f.docid'
+            found = ['s' + str(server)]
+            if author is not None:
+                found.append('u' + str(author))
+            if channel is not None:
+                found.append('c' + str(channel))
+            where = ['messages_fts MATCH ?']
+            params = [ftsQuery(text, found)]
+            if after is not None:
+                where.append(rowid + ' >= ?')
+                params.append(snowflake(after))
+            if before is not None:
+                where.append(rowid + ' < ?')
+                params.append(snowflake(before))
+            sql = ('SELECT m.id, m.channel, m.author, m.name, m.content FROM messages_fts f JOIN messages m ON m.id = ' + rowid +
+                   ' WHERE ' + ' AND '.join(where) + ' ORDER BY ' + rowid + ' DESC LIMIT ?')
+            params.append(limit)
+            with self._read_lock:
+                return self._reader.execute(sql, params).fetchall()
+
+        where = ['m.server = ?']
+        params = [int(server)]
+        if author is not None:
+            where.append('m.author = ?')
+            params.append(int(author))
+        if channel is not None:
+            where.append('m.channel = ?')
+            params.append(int(channel))
+        if after is not None:
+            where.append('m.id >= ?')
+            params.append(snowflake(after))
+        if before is not None:
+            where.append('m.id < ?')
+            params.append(snowflake(before))
+        if text:
+            # only without a full text index
+            where.append("m.content LIKE ? ESCAPE '\\'")
+            params.append('%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        sql = 'SELECT m.id, m.channel, m.author, m.name, m.content FROM messages m WHERE ' + ' AND '.join(where) + ' ORDER BY m.id DESC LIMIT ?'
+        params.append(limit)
+        with self._read_lock:
+            return self._reader.execute(sql, params).fetchall()
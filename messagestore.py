@@ -0,0 +1,111 @@
+import collections, sys
+
+DISCORD_EPOCH = 1420070400000 # ms, the start of snowflake timestamps
+
+
+class StoredMessage:
+    """What the audit log needs to know about a message."""
+    __slots__ = ('id', 'author_id', 'channel_id', 'content')
+
+    def __init__(self, id, author_id, channel_id, content):
+        self.id = id
+        self.author_id = author_id
+        self.channel_id = channel_id
+        self.content = content
+
+    @property
+    def timestamp(self):
+        """Creation time in seconds since the Unix epoch, taken from the snowflake."""
+        return ((self.id >> 22) + DISCORD_EPOCH) / 1000
+
+
+# bytes a record costs besides its content: the object, its int id and its
+# share of the OrderedDict it is kept in. Author and channel ids are interned.
+RECORD_OVERHEAD = sys.getsizeof(StoredMessage(0, '', '', '')) + sys.getsizeof(2 ** 62) + 48
+
+
+def recordSize(content):
+    return RECORD_OVERHEAD + sys.getsizeof(content)
+
+
+class MessageStore:
+    """Messages of every server kept for auditing deletes and edits, within a memory budget.
+
+    Each server keeps its messages oldest first. When the store grows past
+    `budget` bytes the server using the most memory gives up its oldest
+    messages until the store is back under 95% of the budget, so quiet
+    servers keep their history while busy ones churn through theirs.
+    """
+    def __init__(self, budget=64 * 1024 * 1024):
+        self.budget = budget
+        self.size = 0
+        self.evicted = 0
+        self._servers = {} # server id -> OrderedDict of message id -> StoredMessage
+        self._sizes = collections.Counter()
+
+    def __len__(self):
+        return sum(len(messages) for messages in self._servers.values())
+
+    def add(self, server_id, message):
+        messages = self._servers.get(server_id)
+        if messages is None:
+            messages = self._servers[server_id] = collections.OrderedDict()
+        record = StoredMessage(int(message.id), sys.intern(message.author.id), sys.intern(message.channel.id), message.content)
+        old = messages.pop(record.id, None)
+        if old is not None:
+            self._forget(server_id, old)
+        messages[record.id] = record
+        size = recordSize(record.content)
+        self._sizes[server_id] += size
+        self.size += size
+        if self.size > self.budget:
+            self._evict()
+
+    def get(self, server_id, message_id):
+        messages = self._servers.get(server_id)
+        return messages.get(int(message_id)) if messages is not None else None
+
+    def pop(self, server_id, message_id):
+        messages = self._servers.get(server_id)
+        if messages is None:
+            return None
+        record = messages.pop(int(message_id), None)
+        if record is not None:
+            self._forget(server_id, record)
+        return record
+
+    def edit(self, server_id, message_id, content):
+        """Stores the new content of a message and returns the old one, None when the message is unknown."""
+        record = self.get(server_id, message_id)
+        if record is None:
+            return None
+        before = record.content
+        change = sys.getsizeof(content) - sys.getsizeof(before)
+        record.content = content
+        self._sizes[server_id] += change
+        self.size += change
+        return before
+
+    def remove_server(self, server_id):
+        self._servers.pop(server_id, None)
+        self.size -= self._sizes.pop(server_id, 0)
+
+    def _forget(self, server_id, record):
+        size = recordSize(record.content)
+        self._sizes[server_id] -= size
+        self.size -= size
+
+    def _evict(self):
+        target = self.budget * 0.95
+        while self.size > target and self._sizes:
+            server_id, _ = self._sizes.most_common(1)[0]
+            messages = self._servers[server_id]
+            while messages and self.size > target and self._sizes[server_id] > 0:
+                _, record = messages.popitem(last=False)
+                self._forget(server_id, record)
+                self.evicted += 1
+                # hand over to the next largest server once this one is no longer it
+                if len(messages) % 256 == 0:
+                    break
+            if not messages:
+                self.remove_server(server_id)
@@ -0,0 +1,219 @@
+import asyncio, bisect, collections, functools, os, sys, threading, time
+
+# upper bounds of the histogram buckets in seconds, 0.5ms to ~65s
+BOUNDS = tuple(0.0005 * 2 ** i for i in range(18))
+
+
+class Histogram:
+    """Fixed bucket latency histogram."""
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+        return self.max
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class Metrics:
+    """Histograms and gauges of the running bot, rendered in Prometheus text format.
+
+    Gauges are callables sampled on render, returning a number or a
+    {label value: number} dict.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        return hist
+
+    def gauge(self, name, fn, label=None):
+        self.gauges[name] = (fn, label)
+
+    def timed(self, name, **labels):
+        """Decorator recording the run time of a coroutine function."""
+        def decorator(coro):
+            hist = self.histogram(name, **labels)
+            @functools.wraps(coro)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await coro(*args, **kwargs)
+                finally:
+                    hist.observe(time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def instrument_commands(self, bot):
+        """Times every registered command, including argument parsing and checks."""
+        for command in set(bot.commands.values()):
+            if 'invoke' not in command.__dict__:
+                command.invoke = self.timed('command_seconds', command=command.name)(command.invoke)
+
+    async def monitor_lag(self, interval=0.5):
+        hist = self.histogram('loop_lag_seconds')
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            hist.observe(max(0.0, loop.time() - start - interval))
+
+    def render(self):
+        lines = []
+        for (name, labels), hist in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, n in zip(BOUNDS + (float('inf'),), hist.buckets):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', le),)), cumulative))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), hist.count))
+            lines.append('{}_sum{} {:.6f}'.format(name, _labels(labels), hist.sum))
+        for name, (fn, label) in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if isinstance(value, dict):
+                for key, v in sorted(value.items()):
+                    lines.append('{}{} {}'.format(name, _labels(((label or 'key', key),)), v))
+            else:
+                lines.append('{} {}'.format(name, value))
+        lines.append('uptime_seconds {:.0f}'.format(time.time() - self.started))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, name, limit=15):
+        """Short text table of one histogram family, slowest p99 first."""
+        rows = [(dict(labels), hist) for (n, labels), hist in self.histograms.items() if n == name and hist.count]
+        rows.sort(key=lambda row: row[1].percentile(0.99), reverse=True)
+        out = []
+        for labels, hist in rows[:limit]:
+            label = ','.join(str(v) for v in labels.values()) or name
+            out.append('{:<20} {:>7} {:>9.1f} {:>9.1f} {:>9.1f}'.format(label[:20], hist.count,
+                       hist.percentile(0.5) * 1e3, hist.percentile(0.99) * 1e3, hist.max * 1e3))
+        return out
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1] in (b'/', b'/metrics'):
+                body = self.render().encode('utf-8')
+                status = b'200 OK'
+            else:
+                body = b'not found\n'
+                status = b'404 Not Found'
+            writer.write(b'HTTP/1.0 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: '
+                         + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        return await asyncio.start_server(self._handle, host, port)
+
+
+class Profiler:
+    """Sampling profiler of one thread, normally the event loop's.
+
+    A background thread grabs the target thread's stack every `interval`
+    seconds, so the overhead does not depend on how much code runs.
+    """
+    def __init__(self, interval=0.005, depth=64):
+        self.interval = interval
+        self.depth = depth
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, thread_id=None):
+        """Starts sampling the given thread, the calling one by default."""
+        if self._thread is not None:
+            return False
+        self.stacks.clear()
+        self.samples = 0
+        self.started = time.monotonic()
+        self._stop.clear()
+        target = threading.get_ident() if thread_id is None else thread_id
+        self._thread = threading.Thread(target=self._run, args=(target,), name='Profiler', daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self, target):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append('{}:{}({})'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+                self.samples += 1
+
+    def stop(self, path=None, limit=20):
+        """Stops sampling, optionally writes collapsed stacks and returns the hottest functions."""
+        if self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+        if path is not None:
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, n in self.stacks.most_common():
+                    f.write(';'.join(stack) + ' ' + str(n) + '\n')
+
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, n in self.stacks.items():
+            # drop line numbers so every sample of a function adds up
+            names = [frame.rsplit('(', 1)[0] for frame in stack]
+            own[names[-1]] += n
+            for name in set(names):
+                total[name] += n
+
+        samples = max(self.samples, 1)
+        lines = ['{} samples over {:.1f}s'.format(self.samples, time.monotonic() - self.started), '', 'self%  total%  function']
+        for name, n in own.most_common(limit):
+            lines.append('{:5.1f}  {:6.1f}  {}'.format(100.0 * n / samples, 100.0 * total[name] / samples, name))
+        return '\n'.join(lines) + '\n'
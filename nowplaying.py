@@ -0,0 +1,145 @@
+import asyncio, collections, time
+import discord
+from ratelimit import TokenBucket
+
+MAX_LENGTH = 2000
+
+
+def clock(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes >= 60:
+        return '{}:{:02}:{:02}'.format(minutes // 60, minutes % 60, seconds)
+    return '{}:{:02}'.format(minutes, seconds)
+
+
+def progressBar(position, duration, width=20):
+    if not duration:
+        return '`{}`'.format(clock(position))
+    done = min(int(width * position / duration), width - 1)
+    return '`{}●{} {} / {}`'.format('▬' * done, '▬' * (width - done - 1), clock(position), clock(duration))
+
+
+class StatusMessage:
+    """The one message of a server that shows what is playing, edited in place.
+
+    Changes only mark it out of date. The first change opens a `window`
+    that collects the ones following it, then the message is edited once;
+    edits are spaced by a token bucket of `rate` per `per` seconds. While
+    nothing changes it is refreshed every `refresh` seconds to move the
+    progress along, unchanged text is not sent at all. Songs added in a
+    burst are merged into one line. The message is sent again when it was
+    deleted or when it should move to another channel.
+
+    `render()` returns the text of the message without the notes.
+    """
+    NOTE_SECONDS = 30
+    totals = collections.Counter() # sent, edited, unchanged and failed across servers
+
+    def __init__(self, client, render, window=1.0, rate=1, per=2.0, refresh=15.0):
+        self.client = client
+        self.render = render
+        self.window = window
+        self.refresh = refresh
+        self.channel = None
+        self.message = None
+        self._shown = None
+        self._repost = False
+        self._added = [] # titles added since the burst started
+        self._added_by = collections.OrderedDict()
+        self._added_until = 0
+        self._notes = collections.deque(maxlen=3) # (shown until, text)
+        self._bucket = TokenBucket(rate, per)
+        self._dirty = asyncio.Event()
+        self._task = None
+
+    def update(self, channel=None):
+        """Marks the message as out of date, it moves to `channel` if one is given."""
+        if channel is not None and self.channel is not None and channel.id != self.channel.id:
+            self._repost = True
+        if channel is not None:
+            self.channel = channel
+        self._dirty.set()
+        if self._task is None and self.channel is not None:
+            self._task = self.client.loop.create_task(self._run())
+
+    def repost(self, channel):
+        """Sends the message again at the bottom of the channel."""
+        self._repost = True
+        self.update(channel)
+
+    def note(self, text, channel=None):
+        self._notes.append((time.monotonic() + self.NOTE_SECONDS, text))
+        self.update(channel)
+
+    def added(self, title, requester, channel=None):
+        now = time.monotonic()
+        if now > self._added_until:
+            self._added = []
+            self._added_by.clear()
+        self._added.append(title)
+        self._added_by[requester] = None
+        self._added_until = now + self.NOTE_SECONDS
+        self.update(channel)
+
+    def text(self):
+        now = time.monotonic()
+        lines = [self.render()]
+        if self._added and now < self._added_until:
+            titles = ', '.join('*{}*'.format(title) for title in self._added[:3])
+            if len(self._added) > 3:
+                titles += ' and {} more'.format(len(self._added) - 3)
+            lines.append('Added {} by {}'.format(titles, ', '.join(self._added_by)))
+        lines.extend(text for until, text in self._notes if now < until)
+        return '\n'.join(lines)[:MAX_LENGTH]
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._dirty.wait(), self.refresh)
+                await asyncio.sleep(self.window)
+            except asyncio.TimeoutError:
+                pass
+            delay = self._bucket.delay()
+            if delay:
+                await asyncio.sleep(delay)
+            self._bucket.take()
+            self._dirty.clear()
+            try:
+                await self._publish()
+            except discord.HTTPException:
+                self.totals['failed'] += 1
+
+    async def _publish(self):
+        text = self.text()
+        if self._repost and self.message is not None:
+            message, self.message = self.message, None
+            try:
+                await self.client.delete_message(message)
+            except discord.HTTPException:
+                pass
+        self._repost = False
+        if self.message is not None:
+            if text == self._shown:
+                self.totals['unchanged'] += 1
+                return
+            try:
+                await self.client.edit_message(self.message, text)
+                self._shown = text
+                self.totals['edited'] += 1
+                return
+            except discord.NotFound:
+                self.message = None
+        self.message = await self.client.send_message(self.channel, text)
+        self._shown = text
+        self.totals['sent'] += 1
+
+    async def close(self, text=None):
+        """Stops updating, the message is left with `text` if one is given."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if text is not None and self.message is not None:
+            try:
+                await self.client.edit_message(self.message, text)
+            except discord.HTTPException:
+                pass
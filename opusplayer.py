@@ -0,0 +1,302 @@
+import collections, os, resource, struct, subprocess, threading, time
+
+OGG_PAGE = struct.Struct('<4sBBqIIIB') # capture pattern ... number of segments
+
+# frame length in 1/10 ms by the config number in an Opus packet's TOC byte (RFC 6716 3.1)
+FRAME_TENTHS = (100, 200, 400, 600) * 3 + (100, 200) * 2 + (25, 50, 100, 200) * 4
+
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', None) # Linux only
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+class Incompatible(Exception):
+    """The stream cannot be sent without transcoding it."""
+
+
+def packetTenths(packet):
+    """Duration of an Opus packet in 1/10 ms."""
+    toc = packet[0]
+    count = toc & 3
+    frames = 1 if count == 0 else 2 if count < 3 else packet[1] & 0x3F
+    return FRAME_TENTHS[toc >> 3] * frames
+
+
+def oggPackets(stream):
+    """Yields the packets of an Ogg stream read from a binary file object."""
+    partial = b''
+    while True:
+        header = stream.read(OGG_PAGE.size)
+        if len(header) < OGG_PAGE.size:
+            return
+        capture, _, _, _, _, _, _, segments = OGG_PAGE.unpack(header)
+        if capture != b'OggS':
+            raise ValueError('lost Ogg page sync')
+        lacing = stream.read(segments)
+        body = stream.read(sum(lacing))
+        start = 0
+        size = 0
+        for value in lacing:
+            size += value
+            if value < 255:
+                yield partial + body[start:start + size]
+                partial = b''
+                start += size
+                size = 0
+        # a packet that goes on in the next page
+        partial += body[start:start + size]
+
+
+def processSeconds(pid):
+    """CPU time a process has used so far, None once it is gone."""
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    # utime and stime are the 14th and 15th fields, counted from the pid
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def threadSeconds():
+    """CPU time the calling thread has used so far."""
+    if RUSAGE_THREAD is None:
+        return 0.0
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StreamCost:
+    """CPU time a stream costs: its ffmpeg process and the player thread sending it.
+
+    tick() is called by the player thread for every frame, the clocks are
+    read once a second of audio. Sampled while playing because the
+    process is gone by the time the track ends. `worker()` returns the CPU
+    time a pooled transcoder spent encoding the stream.
+    """
+    EVERY = 50
+
+    def __init__(self, path, pid=None, worker=None):
+        self.path = path # 'passthrough', 'transcode', 'pooled' or 'cached'
+        self.pid = pid
+        self.frames = 0
+        self.process = 0.0
+        self.thread = 0.0
+        self.worker = 0.0
+        self._worker = worker
+        self._thread_start = None
+
+    def tick(self):
+        self.frames += 1
+        if self._thread_start is None:
+            self._thread_start = threadSeconds()
+        elif self.frames % self.EVERY == 0:
+            self.sample()
+
+    def sample(self):
+        self.thread = threadSeconds() - self._thread_start
+        if self.pid is not None:
+            process = processSeconds(self.pid)
+            if process is not None:
+                self.process = process
+        if self._worker is not None:
+            self.worker = self._worker()
+
+    @property
+    def seconds(self):
+        return self.process + self.thread + self.worker
+
+    @property
+    def audio(self):
+        return self.frames * 0.02
+
+
+class CountedReads:
+    """Wraps a player's PCM buffer to tick a StreamCost on every frame read."""
+    def __init__(self, raw, cost):
+        self.raw = raw
+        self.cost = cost
+
+    def read(self, size):
+        self.cost.tick()
+        return self.raw.read(size)
+
+
+class CountedFrames:
+    """Wraps the packets of a FramePlayer to tick a StreamCost on every one."""
+    def __init__(self, frames, cost):
+        self.frames = frames
+        self.cost = cost
+
+    def __iter__(self):
+        for packet in self.frames:
+            self.cost.tick()
+            yield packet
+
+    def close(self):
+        close = getattr(self.frames, 'close', None)
+        if close is not None:
+            close()
+
+
+class CostTotals:
+    """CPU and audio seconds of the finished streams by path."""
+    def __init__(self):
+        self.streams = collections.Counter()
+        self.cpu = collections.Counter()
+        self.audio = collections.Counter()
+        self.incompatible = 0 # Opus sources that had to be transcoded after all
+
+    def add(self, cost):
+        self.streams[cost.path] += 1
+        self.cpu[cost.path] += cost.seconds
+        self.audio[cost.path] += cost.audio
+
+    def per_core(self, path):
+        """Streams of a path one core keeps up with, None before any was measured."""
+        if not self.cpu[path]:
+            return None
+        return self.audio[path] / self.cpu[path]
+
+
+class OggOpusSource:
+    """Opus packets of a track demuxed by ffmpeg without decoding them.
+
+    ffmpeg copies the audio stream into Ogg, which is split into packets
+    here. open() reads the stream headers and the first packet and raises
+    Incompatible unless the packets can go to Discord as they are: Opus in
+    20ms frames, stereo or mono. It blocks on the network, run it in a
+    worker thread.
+    """
+    def __init__(self, url, headers=None, before_options=''):
+        self.args = ['ffmpeg'] + before_options.split()
+        for name, value in (headers or {}).items():
+            self.args += ['-headers', '{}: {}\r\n'.format(name, value)]
+        self.args += ['-i', url, '-vn', '-c:a', 'copy', '-f', 'ogg', '-loglevel', 'warning', 'pipe:1']
+        self.process = None
+        self._packets = None
+        self._first = None
+
+    def open(self):
+        self.process = subprocess.Popen(self.args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        try:
+            self._packets = oggPackets(self.process.stdout)
+            head = next(self._packets, b'')
+            # one or two channels without a channel mapping, Opus itself always runs at 48kHz
+            if head[:8] != b'OpusHead' or len(head) < 19 or head[9] not in (1, 2) or head[18] != 0:
+                raise Incompatible('not a mono or stereo Opus stream')
+            next(self._packets, None) # OpusTags
+            self._first = next(self._packets, None)
+            if self._first is None:
+                raise Incompatible('no audio packets')
+            if packetTenths(self._first) != 200:
+                raise Incompatible('frames are not 20ms')
+        except:
+            self.close()
+            raise
+        return self
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+
+    def __iter__(self):
+        yield self._first
+        for packet in self._packets:
+            # a frame size change mid-stream ends the track rather than play it at the wrong speed
+            if packetTenths(packet) != 200:
+                return
+            yield packet
+
+    def close(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+
+
+
+class FramePlayer(threading.Thread):
+    """Sends already encoded 20ms Opus packets to a voice client.
+
+    Has the same interface as discord.py's StreamPlayer, but reads packets
+    from an iterator and hands them to play_audio() without encoding.
+    Volume cannot be applied to encoded packets, it is kept only so code
+    that sets it keeps working.
+    """
+    DELAY = 0.02
+
+    def __init__(self, frames, voice, after=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frames = frames
+        self.voice = voice
+        self.after = after
+        self.volume = 1.0
+        self.loops = 0
+        self._start = None
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._connected = voice._connected
+
+    def run(self):
+        try:
+            self._do_run()
+        finally:
+            self._close()
+            self._end.set()
+            if self.after is not None:
+                try:
+                    self.after()
+                except:
+                    pass
+
+    def _do_run(self):
+        self.loops = 0
+        self._start = time.time()
+        for packet in self.frames:
+            if self._end.is_set():
+                return
+
+            if not self._resumed.is_set():
+                self._resumed.wait()
+                if self._end.is_set():
+                    return
+
+            # like StreamPlayer, the track ends with the voice connection
+            if not self._connected.is_set():
+                self._end.set()
+                return
+
+            self.loops += 1
+            self.voice.play_audio(packet, encode=False)
+            next_time = self._start + self.DELAY * self.loops
+            delay = max(0, self.DELAY + (next_time - time.time()))
+            time.sleep(delay)
+
+    def _close(self):
+        close = getattr(self.frames, 'close', None)
+        if close is not None:
+            close()
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+        if self.ident is None:
+            # never started, run() is not there to close the frames
+            self._close()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self.loops = 0
+        self._start = time.time()
+        self._resumed.set()
+
+    def is_playing(self):
+        return self._resumed.is_set() and not self.is_done()
+
+    def is_done(self):
+        return not self.is_alive() or self._end.is_set()
@@ -0,0 +1,178 @@
+import collections, json, math, os, threading
+
+try:
+    import audioop
+except ImportError: # removed from the standard library in Python 3.13
+    audioop = None
+    import numpy
+
+try:
+    import fcntl
+except ImportError: # Windows, where shards are not run
+    fcntl = None
+
+FULL_SCALE = 32767
+CEILING = int(FULL_SCALE * 0.89) # -1 dBFS, peaks are held below this
+TARGET_RMS = FULL_SCALE * 0.1 # -20 dBFS, the loudness tracks are normalized to
+SILENCE_RMS = FULL_SCALE * 0.01 # -40 dBFS, quieter frames do not count towards loudness
+MIN_GAIN = 0.25
+MAX_GAIN = 3.0
+MAX_VOLUME = 2.0
+RELEASE = 1.05 # per 20ms frame, how fast the limiter lets the gain back up (~2.1dB/100ms)
+MEASURE_FRAMES = 60 * 50 # a minute of non-silent audio is enough to settle a track's gain
+
+
+if audioop is not None:
+    def peak(data):
+        return audioop.max(data, 2)
+
+    def rms(data):
+        return audioop.rms(data, 2)
+
+    def scale(data, factor):
+        return audioop.mul(data, 2, factor)
+else:
+    def peak(data):
+        samples = numpy.frombuffer(data, dtype='<i2')
+        return int(numpy.abs(samples, dtype=numpy.int32).max()) if len(samples) else 0
+
+    def rms(data):
+        samples = numpy.frombuffer(data, dtype='<i2').astype(numpy.float32)
+        return float(numpy.sqrt(numpy.mean(samples * samples))) if len(samples) else 0.0
+
+    def scale(data, factor):
+        samples = numpy.frombuffer(data, dtype='<i2').astype(numpy.float32)
+        samples *= factor
+        numpy.clip(samples, -32768, 32767, out=samples)
+        return samples.astype('<i2').tobytes()
+
+
+def clampVolume(volume):
+    return min(max(volume, 0.0), MAX_VOLUME)
+
+
+class PCMStage:
+    """Applies volume, loudness normalization and a peak limiter to a player's PCM.
+
+    Wraps the ffmpeg stdout of a StreamPlayer, which is then left at volume
+    1.0 so it does not scale the frames a second time. Every 20ms frame is
+    processed with whole-buffer operations. The gain of a frame is the
+    volume times the track's normalization gain, lowered at once when it
+    would push the frame's peak over CEILING and raised back by RELEASE per
+    frame. Nothing is clipped whatever the volume.
+
+    While `gain` is None the track plays unnormalized and its loudness is
+    measured, `measured(gain)` is called once it is known.
+    """
+    def __init__(self, raw, volume=1.0, gain=None, measured=None):
+        self.raw = raw
+        self.volume = clampVolume(volume)
+        self.gain = gain
+        self.measured = measured
+        self.applied = None
+        self._energy = 0.0
+        self._frames = 0
+
+    def read(self, size):
+        data = self.raw.read(size)
+        if self.gain is None and self.measured is not None:
+            self._measure(data, len(data) < size)
+
+        want = self.volume * (self.gain or 1.0)
+        if want == 1.0 and self.applied in (None, 1.0):
+            return data
+        # frames that cannot get louder cannot clip
+        if want > 1.0 or (self.applied or 0) > 1.0:
+            top = peak(data)
+            if top * want > CEILING:
+                factor = CEILING / top
+            else:
+                factor = min(want, self.applied * RELEASE) if self.applied else want
+        else:
+            factor = want
+        self.applied = factor
+        return scale(data, factor) if data else data
+
+    def _measure(self, data, last):
+        if data:
+            level = rms(data)
+            if level > SILENCE_RMS:
+                self._energy += level * level
+                self._frames += 1
+        # short tracks are measured whole, long ones after a minute of audio
+        if self._frames >= MEASURE_FRAMES or (last and self._frames >= 250):
+            loudness = math.sqrt(self._energy / self._frames)
+            self.gain = min(max(TARGET_RMS / loudness, MIN_GAIN), MAX_GAIN)
+            measured, self.measured = self.measured, None
+            measured(self.gain)
+
+
+class GainCache:
+    """Normalization gains by track key, measured once and kept across restarts.
+
+    Shard processes share the file. save() merges it with what the others
+    saved under a lock on `<path>.lock`, the gains they measured are
+    taken in as well.
+    """
+    def __init__(self, path, limit=50000):
+        self.path = path
+        self.limit = limit
+        self._gains = collections.OrderedDict()
+        self._lock = threading.Lock() # gains are measured on player threads
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._gains)
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self):
+        gains = self._read()
+        with self._lock:
+            self._gains.update(gains)
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            saved = self._read()
+            with self._lock:
+                for key, gain in saved.items():
+                    if key not in self._gains:
+                        # older than anything measured here
+                        self._gains[key] = gain
+                        self._gains.move_to_end(key, last=False)
+                while len(self._gains) > self.limit:
+                    self._gains.popitem(last=False)
+                gains = dict(self._gains)
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(gains, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+
+    def get(self, key):
+        with self._lock:
+            gain = self._gains.get(key)
+            if gain is not None:
+                self._gains.move_to_end(key)
+            return gain
+
+    def put(self, key, gain):
+        with self._lock:
+            self._gains[key] = round(gain, 3)
+            self._gains.move_to_end(key)
+            while len(self._gains) > self.limit:
+                self._gains.popitem(last=False)
+            self.dirty = True
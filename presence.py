@@ -0,0 +1,60 @@
+import discord, random
+
+
+class OnlineRegistry:
+    """Members that are not offline, one slot per (server, member).
+
+    Members are kept in a flat list with a key->position index, so adding,
+    removing (swap with the last slot) and a uniform random pick are all O(1).
+    At most `limit` members are tracked, later arrivals are ignored until
+    slots free up.
+    """
+    def __init__(self, limit=100000):
+        self.limit = limit
+        self._members = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self._members)
+
+    @staticmethod
+    def _key(member):
+        return (member.server.id, member.id)
+
+    def add(self, member):
+        key = self._key(member)
+        pos = self._index.get(key)
+        if pos is not None:
+            self._members[pos] = member
+        elif len(self._members) < self.limit:
+            self._index[key] = len(self._members)
+            self._members.append(member)
+
+    def discard(self, member):
+        pos = self._index.pop(self._key(member), None)
+        if pos is None:
+            return
+        last = self._members.pop()
+        if pos < len(self._members):
+            self._members[pos] = last
+            self._index[self._key(last)] = pos
+
+    def update(self, member):
+        if member.status == discord.Status.offline:
+            self.discard(member)
+        else:
+            self.add(member)
+
+    def add_server(self, server):
+        for member in server.members:
+            self.update(member)
+
+    def remove_server(self, server):
+        for member in server.members:
+            self.discard(member)
+
+    def choice(self):
+        """Returns a random online member or None."""
+        if not self._members:
+            return None
+        return random.choice(self._members)
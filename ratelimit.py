@@ -0,0 +1,84 @@
+import time
+
+
+class TokenBucket:
+    """Classic token bucket, `rate` tokens are refilled every `per` seconds."""
+    def __init__(self, rate, per, capacity=None):
+        self.rate = rate
+        self.per = per
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate / self.per)
+            self.updated = now
+
+    def delay(self, now=None):
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) * self.per / self.rate
+
+    def take(self, now=None):
+        """Takes a token if one is available and returns whether it did."""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def full(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= self.capacity
+
+
+class Cooldown:
+    """Token buckets per user and per server for commands that are costly to run.
+
+    A use takes a token from both the user's and the server's bucket, or from
+    neither. Buckets that refilled completely are dropped once there are more
+    than `limit` of them, they behave like new ones.
+    """
+    def __init__(self, user_rate, user_per, server_rate, server_per, limit=10000):
+        self.user_rate = (user_rate, user_per)
+        self.server_rate = (server_rate, server_per)
+        self.limit = limit
+        self.users = {}
+        self.servers = {}
+        self.warned = set() # users told to slow down since their last accepted use
+        self.rejected = 0
+
+    def _bucket(self, buckets, key, rate):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.limit:
+                for old in [k for k, b in buckets.items() if b.full()]:
+                    del buckets[old]
+            bucket = buckets[key] = TokenBucket(*rate)
+        return bucket
+
+    def retry_after(self, user_id, server_id=None):
+        """Takes a use and returns 0, or returns the seconds until one is available."""
+        now = time.monotonic()
+        user = self._bucket(self.users, user_id, self.user_rate)
+        server = self._bucket(self.servers, server_id, self.server_rate) if server_id is not None else None
+        wait = max(user.delay(now), server.delay(now) if server is not None else 0.0)
+        if wait:
+            self.rejected += 1
+            return wait
+        user.take(now)
+        if server is not None:
+            server.take(now)
+        self.warned.discard(user_id)
+        return 0.0
+
+    def warn(self, user_id):
+        """Whether the user should be told about the cooldown, once per run of rejected uses."""
+        if user_id in self.warned:
+            return False
+        self.warned.add(user_id)
+        return True
@@ -0,0 +1,195 @@
+import asyncio, collections, concurrent.futures, itertools, re, threading, time
+
+youtube_dl = None # imported by loadYoutubeDL() on first use, it is slow to import
+
+YTDL_OPTIONS = {
+    'format': 'webm[abr>0]/bestaudio/best',
+    'default_search': 'auto',
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+}
+
+FFMPEG_BEFORE = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+
+# only what playback and VoiceEntry need is kept from youtube_dl's info dict
+INFO_KEYS = ('id', 'extractor', 'title', 'uploader', 'duration', 'url', 'webpage_url',
+             'http_headers', 'is_live', 'acodec', 'abr', 'asr')
+
+_PLAYLIST = re.compile(r'https?://\S*(?:/playlist\b|[?&]list=|/sets/|/album/)')
+_YOUTUBE = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/)|youtu\.be/)([\w-]{11})')
+
+
+def loadYoutubeDL():
+    global youtube_dl
+    if youtube_dl is None:
+        import youtube_dl as module
+        youtube_dl = module
+    return youtube_dl
+
+
+def normalize(query):
+    """Cache key of a play query, equivalent queries share one key."""
+    query = query.strip()
+    match = _YOUTUBE.search(query)
+    if match:
+        return 'youtube:' + match.group(1)
+    if re.match(r'https?://', query):
+        return query.split('#', 1)[0].rstrip('/')
+    return 'search:' + ' '.join(query.lower().split())
+
+
+def isPlaylist(query):
+    """Whether the query is a playlist URL rather than a single track."""
+    query = query.strip()
+    # a watch URL that also carries a list plays just the video, like youtube_dl's noplaylist
+    return bool(_PLAYLIST.match(query)) and not _YOUTUBE.search(query)
+
+
+def flatInfo(item):
+    """Turns a flat playlist item into an info dict that still has to be resolved."""
+    url = item.get('url') or item.get('id') or ''
+    extractor = (item.get('ie_key') or '').lower() or None
+    if extractor == 'youtube' and not url.startswith('http'):
+        url = 'https://www.youtube.com/watch?v=' + url
+    return {
+        'id': item.get('id'),
+        'extractor': extractor,
+        'title': item.get('title') or url,
+        'uploader': item.get('uploader'),
+        'duration': item.get('duration'),
+        'webpage_url': url,
+        'resolved_at': 0,
+    }
+
+
+class Resolver:
+    """Resolves play queries to stream info off the event loop.
+
+    Extraction runs in a bounded thread pool. Identical queries that are
+    already being extracted wait on the same future instead of starting a
+    second extraction. Results are kept in an LRU cache whose entries expire
+    after `ttl` seconds, since the stream URLs handed out by most sites do.
+
+    `observe` is called with the duration of every finished extraction.
+    """
+    def __init__(self, loop, workers=4, cache_size=512, ttl=1800, options=None, observe=None):
+        self.loop = loop
+        self.observe = observe
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.options = dict(YTDL_OPTIONS, **(options or {}))
+        self.stats = collections.Counter()
+        self._cache = collections.OrderedDict()
+        self._inflight = {}
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def cached(self, key):
+        item = self._cache.get(key)
+        if item is None:
+            return None
+        expires, info = item
+        if expires < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return info
+
+    def _store(self, key, info):
+        expires = time.monotonic() + self.ttl
+        keys = [key]
+        if info.get('webpage_url'):
+            keys.append(normalize(info['webpage_url']))
+        for k in keys:
+            self._cache[k] = (expires, info)
+            self._cache.move_to_end(k)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, query):
+        self._cache.pop(normalize(query), None)
+
+    async def resolve(self, query, refresh=False):
+        """Returns the info dict of the first result of `query`."""
+        key = normalize(query)
+        if not refresh:
+            info = self.cached(key)
+            if info is not None:
+                self.stats['hits'] += 1
+                return info
+
+        future = self._inflight.get(key)
+        if future is None:
+            self.stats['misses'] += 1
+            future = self.loop.run_in_executor(self._executor, self._extract, query)
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.stats['joined'] += 1
+        return await asyncio.shield(future)
+
+    def _done(self, key, future):
+        self._inflight.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            info = future.result()
+            self._store(key, info)
+            if self.observe is not None:
+                self.observe(info['resolve_time'])
+
+    def _ydl(self):
+        ydl = getattr(self._local, 'ydl', None)
+        if ydl is None:
+            ydl = self._local.ydl = loadYoutubeDL().YoutubeDL(self.options)
+        return ydl
+
+    def _extract(self, query):
+        started = time.monotonic()
+        info = self._ydl().extract_info(query, download=False)
+        if 'entries' in info:
+            entries = [entry for entry in info['entries'] if entry]
+            if not entries:
+                raise youtube_dl.utils.DownloadError('No results for ' + query)
+            info = entries[0]
+        info = {key: info.get(key) for key in INFO_KEYS}
+        info['resolved_at'] = time.time()
+        info['resolve_time'] = time.monotonic() - started
+        return info
+
+    def _open_playlist(self, query):
+        ydl = getattr(self._local, 'flat', None)
+        if ydl is None:
+            ydl = self._local.flat = loadYoutubeDL().YoutubeDL(dict(self.options, extract_flat='in_playlist', noplaylist=False))
+        # process=False leaves 'entries' as the extractor's lazy page generator
+        info = ydl.extract_info(query, download=False, process=False)
+        return iter(info.get('entries') or ())
+
+    async def playlist(self, query, limit=1000, page=50):
+        """Yields flat info dicts of a playlist's entries, fetching them page by page."""
+        entries = await self.loop.run_in_executor(self._executor, self._open_playlist, query)
+        take = lambda: list(itertools.islice(entries, page))
+        count = 0
+        while count < limit:
+            items = await self.loop.run_in_executor(self._executor, take)
+            if not items:
+                return
+            for item in items[:limit - count]:
+                if item:
+                    count += 1
+                    yield flatInfo(item)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def createPlayer(voice, info, **kwargs):
+    """Builds an ffmpeg player from resolved info, like create_ytdl_player does."""
+    kwargs.setdefault('before_options', FFMPEG_BEFORE)
+    player = voice.create_ffmpeg_player(info['url'], headers=info.get('http_headers'), **kwargs)
+    player.download_url = info['url']
+    player.url = info.get('webpage_url')
+    player.title = info.get('title')
+    player.uploader = info.get('uploader')
+    player.duration = info.get('duration')
+    player.is_live = info.get('is_live')
+    return player
@@ -0,0 +1,191 @@
+"""Runs the bot as several shard processes under a small supervisor.
+
+Every shard is its own process with its own client, Music cog and voice
+states, so gateway decoding and audio work of different servers run on
+different cores. Crashed shards are restarted with exponential backoff and
+the metrics of all shards are merged on METRICS_PORT, each shard's own
+endpoint being on METRICS_PORT + 1 + shard id.
+
+    python3 shards.py --shards 4
+    python3 shards.py --shards 4 --fake -- --rate 200 --duration 30
+
+--fake runs bench/loadtest.py in every shard instead of connecting to
+Discord, anything after -- is passed on to it.
+"""
+import argparse, multiprocessing, os, signal, sys, threading, time, urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def runShard(shard_id, shard_count, fake_args):
+    os.environ['SHARD_ID'] = str(shard_id)
+    os.environ['SHARD_COUNT'] = str(shard_count)
+    sys.path.insert(0, ROOT)
+    if fake_args is None:
+        import DiscordBot
+        DiscordBot.main()
+    else:
+        from bench import loadtest
+        loadtest.main(fake_args + ['--seed', str(47 + shard_id)])
+
+
+def relabel(text, shard_id):
+    """Adds a shard label to every sample of a Prometheus text payload."""
+    out = []
+    label = 'shard="{}"'.format(shard_id)
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, sep, rest = line.partition('{')
+        if sep:
+            out.append(name + '{' + label + ',' + rest)
+        else:
+            name, _, value = line.partition(' ')
+            out.append(name + '{' + label + '} ' + value)
+    return out
+
+
+class Shard:
+    def __init__(self, id):
+        self.id = id
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.backoff = 1.0
+        self.restart_at = None
+        self.done = False
+
+
+class Supervisor:
+    STABLE_AFTER = 60 # a shard that ran this long gets its backoff reset
+
+    def __init__(self, count, fake_args=None, metrics_port=0, max_backoff=300):
+        self.count = count
+        self.fake_args = fake_args
+        self.metrics_port = metrics_port
+        self.max_backoff = max_backoff
+        self.shards = [Shard(i) for i in range(count)]
+        self.context = multiprocessing.get_context('spawn')
+        self.stopping = threading.Event()
+
+    def log(self, *args):
+        print('[supervisor]', *args, flush=True)
+
+    def shard_port(self, shard):
+        return self.metrics_port + 1 + shard.id if self.metrics_port else 0
+
+    def spawn(self, shard):
+        args = None
+        if self.fake_args is not None:
+            args = list(self.fake_args)
+            if self.metrics_port:
+                args += ['--metrics-port', str(self.shard_port(shard))]
+        shard.process = self.context.Process(target=runShard, args=(shard.id, self.count, args), name='shard-' + str(shard.id))
+        shard.process.start()
+        shard.started = time.monotonic()
+        shard.restart_at = None
+        self.log('shard', shard.id, 'started, pid', shard.process.pid)
+
+    def check(self, shard):
+        if shard.done or shard.restart_at is not None or shard.process.is_alive():
+            return
+        code = shard.process.exitcode
+        if self.fake_args is not None and code == 0:
+            shard.done = True
+            self.log('shard', shard.id, 'finished')
+            return
+        if time.monotonic() - shard.started > self.STABLE_AFTER:
+            shard.backoff = 1.0
+        shard.restart_at = time.monotonic() + shard.backoff
+        self.log('shard', shard.id, 'exited with', code, '- restarting in {:.0f}s'.format(shard.backoff))
+        shard.backoff = min(shard.backoff * 2, self.max_backoff)
+
+    def run(self):
+        for shard in self.shards:
+            self.spawn(shard)
+        while not self.stopping.wait(1):
+            for shard in self.shards:
+                self.check(shard)
+                if shard.restart_at is not None and time.monotonic() >= shard.restart_at:
+                    shard.restarts += 1
+                    self.spawn(shard)
+            if all(shard.done for shard in self.shards):
+                break
+        self.shutdown()
+
+    def shutdown(self, timeout=10):
+        for shard in self.shards:
+            if shard.process is not None and shard.process.is_alive():
+                shard.process.terminate()
+        for shard in self.shards:
+            if shard.process is not None:
+                shard.process.join(timeout)
+
+    def scrape(self):
+        lines = []
+        for shard in self.shards:
+            up = shard.process is not None and shard.process.is_alive()
+            lines.append('shard_up{{shard="{}"}} {}'.format(shard.id, int(up)))
+            lines.append('shard_restarts_total{{shard="{}"}} {}'.format(shard.id, shard.restarts))
+            if not up:
+                continue
+            try:
+                with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(self.shard_port(shard)), timeout=2) as response:
+                    lines.extend(relabel(response.read().decode('utf-8'), shard.id))
+            except OSError:
+                pass
+        return '\n'.join(lines) + '\n'
+
+    def serve(self):
+        supervisor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = supervisor.scrape().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = Server((os.environ.get('METRICS_HOST', '127.0.0.1'), self.metrics_port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the bot as several shard processes.')
+    parser.add_argument('--shards', type=int, default=int(os.environ.get('SHARD_COUNT', '1')))
+    parser.add_argument('--fake', action='store_true', help='run the offline load test in every shard')
+    parser.add_argument('--metrics-port', type=int, default=int(os.environ.get('METRICS_PORT', '9147')))
+    parser.add_argument('loadtest', nargs=argparse.REMAINDER, help='arguments for bench/loadtest.py')
+    args = parser.parse_args()
+
+    fake_args = None
+    if args.fake:
+        fake_args = [arg for arg in args.loadtest if arg != '--']
+
+    supervisor = Supervisor(args.shards, fake_args, args.metrics_port)
+    if args.metrics_port:
+        supervisor.serve()
+    signal.signal(signal.SIGTERM, lambda *_: supervisor.stopping.set())
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        supervisor.stopping.set()
+        supervisor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import asyncio, collections, itertools, random
+
+
+class SongQueue:
+    """Music queue that can be listed and edited while a player waits on it.
+
+    Has the parts of asyncio.Queue VoiceState uses (put, get, get_nowait,
+    qsize, empty) plus positional access, removal, moves and shuffling.
+    Entries are kept in a deque, the edits are linear in the queue length
+    and take a few milliseconds at most for 10k entries. `owner(entry)` names
+    the user an entry counts against, put_nowait raises asyncio.QueueFull
+    once a user has `per_user` entries queued.
+    """
+    def __init__(self, owner, per_user=None, loop=None):
+        self.owner = owner
+        self.per_user = per_user
+        self._loop = loop or asyncio.get_event_loop()
+        self._entries = collections.deque()
+        self._counts = collections.Counter()
+        self._getters = collections.deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __getitem__(self, index):
+        return self._entries[index]
+
+    def qsize(self):
+        return len(self._entries)
+
+    def empty(self):
+        return not self._entries
+
+    def count(self, user):
+        return self._counts[user]
+
+    def room(self, user):
+        """How many more entries the user may queue, None without a limit."""
+        if self.per_user is None:
+            return None
+        return max(self.per_user - self._counts[user], 0)
+
+    def peek(self, n):
+        return list(itertools.islice(self._entries, n))
+
+    def page(self, number, size=10):
+        """Entries of a 1-based page."""
+        start = (number - 1) * size
+        return list(itertools.islice(self._entries, start, start + size))
+
+    def _wakeup(self):
+        while self._getters:
+            waiter = self._getters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def put_nowait(self, entry):
+        user = self.owner(entry)
+        if self.per_user is not None and self._counts[user] >= self.per_user:
+            raise asyncio.QueueFull()
+        self._entries.append(entry)
+        self._counts[user] += 1
+        self._wakeup()
+
+    async def put(self, entry):
+        self.put_nowait(entry)
+
+    def get_nowait(self):
+        if not self._entries:
+            raise asyncio.QueueEmpty()
+        entry = self._entries.popleft()
+        self._forget(entry)
+        return entry
+
+    async def get(self):
+        while not self._entries:
+            waiter = self._loop.create_future()
+            self._getters.append(waiter)
+            try:
+                await waiter
+            except:
+                waiter.cancel()
+                if self._entries and not waiter.cancelled():
+                    self._wakeup()
+                raise
+        return self.get_nowait()
+
+    def _forget(self, entry):
+        user = self.owner(entry)
+        self._counts[user] -= 1
+        if self._counts[user] <= 0:
+            del self._counts[user]
+
+    def remove(self, index):
+        """Removes and returns the entry at a 0-based position."""
+        entry = self._entries[index]
+        del self._entries[index]
+        self._forget(entry)
+        return entry
+
+    def remove_by(self, user):
+        """Removes and returns every entry of a user."""
+        removed = [entry for entry in self._entries if self.owner(entry) == user]
+        if removed:
+            self._entries = collections.deque(entry for entry in self._entries if self.owner(entry) != user)
+            self._counts.pop(user, None)
+        return removed
+
+    def move(self, source, target):
+        """Moves the entry at one 0-based position to another."""
+        entry = self._entries[source]
+        del self._entries[source]
+        self._entries.insert(target, entry)
+        return entry
+
+    def shuffle(self):
+        entries = list(self._entries)
+        random.shuffle(entries)
+        self._entries = collections.deque(entries)
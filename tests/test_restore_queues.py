@@ -0,0 +1,50 @@
+"""Music.restore_queues against a real queue journal, run with python3 -m unittest discover tests."""
+import asyncio, os, sys, tempfile, types, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from journal import QueueJournal
+
+# the bot writes its logs relative to the working directory when imported
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix='restore-'))
+try:
+    import DiscordBot
+finally:
+    os.chdir(_cwd)
+
+
+class RestoreQueuesTest(unittest.TestCase):
+    def test_saved_servers_are_restored(self):
+        folder = tempfile.mkdtemp(prefix='journal-')
+        path = os.path.join(folder, 'queues.jsonl')
+        journal = QueueJournal(path)
+        journal.start()
+        journal.record('voice', '1', c='10')
+        journal.record('add', '1', e=1, d={'query': 'song', 'title': 'song'})
+        journal.record('current', '1', e=1)
+        journal.record('pos', '1', t=42.0)
+        journal.close()
+
+        restored = []
+        async def restore_queue(server_id, queue):
+            restored.append((server_id, queue['voice'], list(queue['entries']), queue['pos']))
+        async def journal_positions():
+            pass
+        loop = asyncio.get_event_loop()
+        music = types.SimpleNamespace(journal=QueueJournal(path), restore_queue=restore_queue,
+                                      journal_positions=journal_positions, bot=types.SimpleNamespace(loop=loop))
+        try:
+            loop.run_until_complete(DiscordBot.Music.restore_queues(music))
+            loop.run_until_complete(asyncio.sleep(0))
+        finally:
+            music.journal.close()
+
+        self.assertEqual(restored, [('1', '10', [1], 42.0)])
+        # restored servers are journaled again under new entry ids
+        self.assertEqual(music.journal.servers, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+"""Transcoding of tracks to Opus in a pool of long-lived worker processes.
+
+A worker is a Python process running this file. It gets tracks to
+transcode over its stdin and sends the encoded packets back over its
+stdout, each track decoded by its own ffmpeg and encoded on its own
+thread, so one worker serves many streams. The workers are started once
+and kept, not spawned per track, and the libopus encoding and PCM stage
+run on their cores instead of the bot's.
+
+A worker sends at most CREDIT packets ahead of what the player has taken,
+the player hands out more every CREDIT_EVERY packets.
+"""
+import collections, os, queue, subprocess, sys, threading
+from multiprocessing.connection import Connection
+
+import discord
+from audiocache import SAMPLING_RATE, CHANNELS, FRAME_SAMPLES, FRAME_BYTES
+from opusplayer import threadSeconds
+from pcm import PCMStage
+from resolver import FFMPEG_BEFORE
+
+CREDIT = 250 # 5s of audio
+CREDIT_EVERY = 50
+
+
+class TranscodeError(Exception):
+    """The track could not be transcoded."""
+
+
+def decodeArgs(url, headers=None, before_options=FFMPEG_BEFORE):
+    """ffmpeg command line that decodes a track to the PCM the workers encode."""
+    args = ['ffmpeg'] + before_options.split()
+    for name, value in (headers or {}).items():
+        args += ['-headers', '{}: {}\r\n'.format(name, value)]
+    return args + ['-i', url, '-vn', '-f', 's16le', '-ar', str(SAMPLING_RATE), '-ac', str(CHANNELS),
+                   '-loglevel', 'warning', 'pipe:1']
+
+#Worker process
+
+class _Job:
+    def __init__(self, id, send, args, volume, gain):
+        self.id = id
+        self.send = send
+        self.args = args
+        measured = (lambda gain: send('gain', id, gain)) if gain is None else None
+        self.stage = PCMStage(None, volume, gain, measured)
+        self.credit = threading.Semaphore(CREDIT)
+        self.process = None
+        self.stopped = False
+
+    def run(self):
+        error = None
+        frames = 0
+        try:
+            self.process = subprocess.Popen(self.args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+            self.stage.raw = self.process.stdout
+            self.send('started', self.id, self.process.pid)
+            encoder = discord.opus.Encoder(SAMPLING_RATE, CHANNELS)
+            started = threadSeconds()
+            while not self.stopped:
+                pcm = self.stage.read(FRAME_BYTES)
+                if len(pcm) < FRAME_BYTES:
+                    break
+                packet = encoder.encode(pcm, FRAME_SAMPLES)
+                self.credit.acquire()
+                if self.stopped:
+                    break
+                self.send('packet', self.id, packet)
+                frames += 1
+                if frames % CREDIT_EVERY == 0:
+                    self.send('cpu', self.id, threadSeconds() - started)
+            if not frames and not self.stopped and self.process.wait() != 0:
+                error = 'ffmpeg exited with {}'.format(self.process.returncode)
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            self.close()
+            self.send('end', self.id, error)
+
+    def grant(self, count):
+        for _ in range(count):
+            self.credit.release()
+
+    def stop(self):
+        self.stopped = True
+        self.credit.release()
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+    def close(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+
+
+def workerMain(requests, replies, library):
+    if not discord.opus.is_loaded():
+        discord.opus.load_opus(library)
+    lock = threading.Lock()
+    def send(*message):
+        with lock:
+            replies.send(message)
+
+    jobs = {}
+    def run(job):
+        try:
+            job.run()
+        finally:
+            jobs.pop(job.id, None)
+
+    while True:
+        try:
+            message = requests.recv()
+        except EOFError:
+            break # the bot is gone
+        op, id = message[0], message[1]
+        if op == 'start':
+            job = jobs[id] = _Job(id, send, *message[2:])
+            threading.Thread(target=run, args=(job,), daemon=True).start()
+            continue
+        job = jobs.get(id)
+        if job is None:
+            continue
+        if op == 'volume':
+            job.stage.volume = message[2]
+        elif op == 'credit':
+            job.grant(message[2])
+        elif op == 'stop':
+            job.stop()
+    for job in list(jobs.values()):
+        job.stop()
+
+#Bot side
+
+class _Worker:
+    def __init__(self, library):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), library],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._requests = Connection(os.dup(self.process.stdin.fileno()), readable=False)
+        self._replies = Connection(os.dup(self.process.stdout.fileno()), writable=False)
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.streams = {}
+        self.alive = True
+        self._lock = threading.Lock() # requests come from the event loop and the player threads
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def send(self, *message):
+        with self._lock:
+            self._requests.send(message)
+
+    def _read(self):
+        try:
+            while True:
+                op, id, value = self._replies.recv()
+                stream = self.streams.get(id)
+                if stream is None:
+                    continue
+                if op == 'packet':
+                    stream._packets.put(value)
+                elif op == 'started':
+                    stream.pid = value
+                elif op == 'cpu':
+                    stream.cpu = value
+                elif op == 'gain' and stream.measured is not None:
+                    stream.measured(value)
+                elif op == 'end':
+                    del self.streams[id]
+                    stream._end(value)
+        except (EOFError, OSError):
+            pass
+        self.alive = False
+        for stream in list(self.streams.values()):
+            stream._end('the transcoder worker exited')
+        self.streams.clear()
+
+    def close(self):
+        self._requests.close() # the worker exits once its stdin is closed
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class TranscoderPool:
+    """Up to `workers` transcoder processes, started when first needed.
+
+    New streams go to the worker with the fewest, a worker that exited is
+    replaced by the next stream that needs one. `library` is the libopus
+    the workers load.
+    """
+    def __init__(self, workers, library='libopus.so'):
+        self.size = workers
+        self.library = library
+        self.stats = collections.Counter()
+        self._workers = []
+        self._ids = 0
+        self._lock = threading.Lock()
+
+    @property
+    def streams(self):
+        return sum(len(worker.streams) for worker in self._workers)
+
+    def _assign(self, stream):
+        with self._lock:
+            alive = [worker for worker in self._workers if worker.alive]
+            self.stats['exited'] += len(self._workers) - len(alive)
+            self._workers = alive
+            if len(self._workers) < self.size:
+                self._workers.append(_Worker(self.library))
+                self.stats['started'] += 1
+            worker = min(self._workers, key=lambda worker: len(worker.streams))
+            self._ids += 1
+            worker.streams[self._ids] = stream
+            return worker, self._ids
+
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+
+class TranscodedStream:
+    """Opus packets of a track transcoded by a pool worker, for a FramePlayer.
+
+    open() starts the transcode and waits for the first packet, it raises
+    TranscodeError when there is none. It blocks, run it in a worker thread.
+    Setting `volume` goes to the PCM stage in the worker.
+    `measured(gain)` is called like PCMStage does while `gain` is None.
+    """
+    def __init__(self, pool, args, volume=1.0, gain=None, measured=None):
+        self.pool = pool
+        self.args = args
+        self.gain = gain
+        self.measured = measured
+        self.pid = None # of the ffmpeg process
+        self.cpu = 0.0 # CPU time the worker's encoding thread spent on it
+        self._volume = volume
+        self._worker = None
+        self._id = None
+        self._packets = queue.Queue()
+        self._first = None
+        self._error = None
+        self._closed = False
+
+    def open(self):
+        self._worker, self._id = self.pool._assign(self)
+        try:
+            self._worker.send('start', self._id, self.args, self._volume, self.gain)
+        except OSError as e:
+            self._end(str(e))
+        self._first = self._packets.get()
+        if self._first is None:
+            if not self._closed:
+                self.pool.stats['failed'] += 1
+            raise TranscodeError(self._error or 'no audio')
+        self.pool.stats['streams'] += 1
+        return self
+
+    def cpu_seconds(self):
+        return self.cpu
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, volume):
+        self._volume = volume
+        self._send('volume', volume)
+
+    def _send(self, op, value=None):
+        if self._worker is None or self._closed:
+            return
+        try:
+            self._worker.send(op, self._id, value)
+        except OSError:
+            pass
+
+    def _end(self, error):
+        self._error = error
+        self._packets.put(None)
+
+    def __iter__(self):
+        packet = self._first
+        taken = 0
+        while packet is not None:
+            yield packet
+            taken += 1
+            if taken % CREDIT_EVERY == 0:
+                self._send('credit', CREDIT_EVERY)
+            packet = self._packets.get()
+
+    def close(self):
+        self._send('stop')
+        self._closed = True
+
+
+if __name__ == '__main__':
+    requests = Connection(os.dup(0), writable=False)
+    replies = Connection(os.dup(1), readable=False)
+    os.dup2(2, 1) # anything printed goes to stderr, stdout carries the packets
+    workerMain(requests, replies, sys.argv[1])
@@ -0,0 +1,118 @@
+import asyncio, collections, random, time
+from ratelimit import TokenBucket
+
+import discord
+
+
+class VoiceConnector:
+    """Joins voice channels for every server through one pool of handshakes.
+
+    At most `concurrency` handshakes run at once and new ones start at no
+    more than `rate` per second, so rejoining every server after a restart
+    or a voice outage does not fire them all at the same moment. A failed
+    attempt is retried up to `attempts` times after a jittered exponential
+    backoff (a random delay of up to `base * 2**n`, at most `cap` seconds)
+    spent outside the pool. A handshake taking longer than `timeout` seconds
+    counts as failed. `observe(seconds)` gets the duration of every
+    successful one.
+
+    Connected clients are checked every `check_every` seconds, `dropped(voice)`
+    is called for a client whose voice websocket closed under it. The library
+    does not notice that itself, its players keep sending into a dead socket.
+    """
+    def __init__(self, bot, concurrency=4, rate=5, attempts=5, base=1.0, cap=60.0, timeout=30.0, check_every=5.0, observe=None, dropped=None):
+        self.bot = bot
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.timeout = timeout
+        self.check_every = check_every
+        self.observe = observe
+        self.dropped = dropped
+        self.stats = collections.Counter()
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._pace = TokenBucket(rate, 1.0)
+        self._leaving = set() # servers disconnected on purpose, not drops
+        self._task = None
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    async def connect(self, channel):
+        """Joins a voice channel, raises the last error once every attempt failed.
+
+        ClientException (already connected) and InvalidArgument (not a voice
+        channel) are raised at once, retrying does not change them.
+        """
+        server = channel.server
+        for attempt in range(self.attempts):
+            if attempt:
+                self.stats['retries'] += 1
+                await asyncio.sleep(self.backoff(attempt))
+            self.waiting += 1
+            try:
+                await self._slots.acquire()
+            finally:
+                self.waiting -= 1
+            try:
+                delay = self._pace.delay()
+                while delay:
+                    await asyncio.sleep(delay)
+                    delay = self._pace.delay()
+                self._pace.take()
+                started = time.perf_counter()
+                voice = await asyncio.wait_for(self.bot.join_voice_channel(channel), self.timeout)
+            except (discord.ClientException, discord.InvalidArgument):
+                raise
+            except Exception:
+                self.stats['failed'] += 1
+                # a half made connection would fail the next attempt as already connected
+                await self._abandon(server)
+                if attempt == self.attempts - 1:
+                    raise
+                continue
+            finally:
+                self._slots.release()
+            self.stats['connected'] += 1
+            if self.observe is not None:
+                self.observe(time.perf_counter() - started)
+            self._leaving.discard(server.id)
+            if self._task is None and self.dropped is not None:
+                self._task = self.bot.loop.create_task(self._watch())
+            return voice
+
+    async def _abandon(self, server):
+        voice = self.bot.voice_client_in(server)
+        try:
+            if voice is not None:
+                await voice.disconnect()
+            if self.bot.is_voice_connected(server):
+                await self.bot.ws.voice_state(server.id, None, self_mute=True)
+        except Exception:
+            pass
+
+    async def disconnect(self, voice):
+        """Leaves a voice channel on purpose, errors of a connection that is already gone are ignored."""
+        self._leaving.add(voice.server.id)
+        try:
+            await voice.disconnect()
+        except Exception:
+            pass
+        await self._abandon(voice.server)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.check_every)
+            for voice in list(self.bot.voice_clients):
+                ws = getattr(voice, 'ws', None)
+                if ws is None or ws.open or voice.server.id in self._leaving:
+                    continue
+                self.stats['dropped'] += 1
+                self._leaving.add(voice.server.id)
+                self.dropped(voice)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None